@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Collapses the packets of a NoMoAds file into flows: one record per (tcp.stream, host), which is what the analyses
+count. A flow carries the number of its packets, the union of their PII types, the timestamps of its first and last
+packets, and for each filter list whether any of its packets was blocked.
+"""
+
+import argparse
+import json
+
+import json_keys
+import packet_store
+
+# Fields copied from the first packet of a flow
+FLOW_FIELDS = [json_keys.protocol, json_keys.src_ip, json_keys.dst_ip, json_keys.dst_port, json_keys.tcpstream,
+               json_keys.host, json_keys.package_name, json_keys.version]
+
+
+def get_flow_key(packet):
+    """
+    :return: the (tcp.stream, host) of a packet; either one is None if the packet does not have it
+    """
+    return packet.get(json_keys.tcpstream), packet.get(json_keys.host)
+
+
+def get_flow_id(flow_key):
+    tcp_stream, host = flow_key
+    return "%s-%s" % ("" if tcp_stream is None else tcp_stream, host or "")
+
+
+class FlowAggregator:
+    """
+    Aggregates packets into flows, one packet at a time.
+    """
+
+    def __init__(self, block_decision_keys=()):
+        """
+        :param block_decision_keys: json keys of the block decisions (0 or 1) of the packets, e.g., the names of the
+            filter lists. The flow gets 1 if any of its packets has 1.
+        """
+        self.block_decision_keys = list(block_decision_keys)
+        # flow key -> flow record, in the order of the first packet of each flow
+        self.flows = {}
+        # flow key -> set of PII types
+        self.pii_types = {}
+
+    def add(self, packet):
+        flow_key = get_flow_key(packet)
+        flow = self.flows.get(flow_key)
+        ts = packet.get(json_keys.ts)
+        if flow is None:
+            flow = {field: packet[field] for field in FLOW_FIELDS if field in packet}
+            flow[json_keys.packet_count] = 0
+            flow[json_keys.first_ts] = ts
+            flow[json_keys.last_ts] = ts
+            for key in self.block_decision_keys:
+                flow[key] = 0
+            self.flows[flow_key] = flow
+            self.pii_types[flow_key] = set()
+
+        flow[json_keys.packet_count] += 1
+        if ts is not None:
+            # timestamps are epoch strings, e.g., "1620000000.000054000"
+            if flow[json_keys.first_ts] is None or float(ts) < float(flow[json_keys.first_ts]):
+                flow[json_keys.first_ts] = ts
+            if flow[json_keys.last_ts] is None or float(ts) > float(flow[json_keys.last_ts]):
+                flow[json_keys.last_ts] = ts
+        self.pii_types[flow_key].update(packet.get(json_keys.pii_label, ()))
+        for key in self.block_decision_keys:
+            if packet.get(key) == 1:
+                flow[key] = 1
+
+    def get_flows(self):
+        """
+        :return: a dictionary of flow id -> flow record, with the fields of packets in NoMoAds format plus
+                 packet_count, first_ts and last_ts, and the PII types sorted
+        """
+        flows = {}
+        for flow_key, flow in self.flows.items():
+            flow[json_keys.pii_label] = sorted(self.pii_types[flow_key])
+            flows[get_flow_id(flow_key)] = flow
+        return flows
+
+
+def aggregate_packets(packets, block_decision_keys=()):
+    """
+    :param packets: a dictionary of key -> packet in NoMoAds format
+    :param block_decision_keys: json keys of the block decisions of the packets
+    :return: a dictionary of flow id -> flow record, see FlowAggregator.get_flows
+    """
+    aggregator = FlowAggregator(block_decision_keys)
+    for packet in packets.values():
+        aggregator.add(packet)
+    return aggregator.get_flows()
+
+
+def read_packets(full_path, columns=None):
+    """
+    :param full_path: a NoMoAds json file or a Parquet packet store
+    :param columns: for a Parquet packet store, the columns to read
+    """
+    if packet_store.is_packet_store(full_path):
+        return packet_store.read_packets(full_path, columns=columns)
+    return packet_store.read_json_packets(full_path)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Collapses the packets of a NoMoAds file into flows keyed by "
+                                             "(tcp.stream, host).")
+    ap.add_argument('in_file', help='NoMoAds json file or Parquet packet store, optionally annotated with block '
+                                    'decisions.')
+    ap.add_argument('out_file', help='json file where the flows are written.')
+    ap.add_argument('--block_decision_keys', nargs='*', default=[],
+                    help='json keys of the block decisions to aggregate, e.g., the names of the filter lists.')
+    args = ap.parse_args()
+
+    flows = aggregate_packets(read_packets(args.in_file), args.block_decision_keys)
+    with open(args.out_file, "w") as jf:
+        json.dump(flows, jf, sort_keys=True, indent=4)
+    print("Aggregated packets into %d flows" % len(flows))
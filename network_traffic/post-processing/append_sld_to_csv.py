@@ -1,10 +1,7 @@
-import unicodecsv as csv
 import argparse
-import tldextract
-
-
-def _get_second_level_domain_from_tld(url_tld):
-    return url_tld.domain + "." + url_tld.suffix
+import numpy as np
+import pandas as pd
+import public_suffix
 
 
 # =================== CSV column names ===================
@@ -14,6 +11,40 @@ keyset = [csv_key_hostname]
 # ========================================================
 
 
+def get_second_level_domains(hostnames):
+    """
+    :param hostnames: an iterable of distinct hostnames; missing hostnames (None or NaN) are treated as empty
+    :return: a list with the second level domain of each hostname, e.g., "." for an empty hostname
+    """
+    slds = []
+    for hostname in hostnames:
+        if not isinstance(hostname, str):
+            hostname = ""
+        slds.append(public_suffix.get_second_level_domain(hostname))
+    return slds
+
+
+def append_sld(data, hostname_column=csv_key_hostname, sld_column=csv_key_sld_label):
+    """
+    Appends the second level domain of the hostname of each row. The second level domains are computed once per
+    distinct hostname and then mapped back to the rows.
+    :param data: a pandas DataFrame, or a pyarrow Table
+    :return: the DataFrame, with the new column added in place, or a new Table with the new column
+    """
+    if isinstance(data, pd.DataFrame):
+        codes, uniques = pd.factorize(data[hostname_column], sort=False)
+        # factorize gives missing hostnames the code -1: map them to the last entry
+        slds = np.array(get_second_level_domains(list(uniques) + [None]), dtype=object)
+        data[sld_column] = slds[codes]
+        return data
+
+    import pyarrow as pa
+    encoded = data.column(hostname_column).combine_chunks().dictionary_encode()
+    slds = pa.array(get_second_level_domains(encoded.dictionary.to_pylist()), type=pa.string())
+    sld_array = slds.take(encoded.indices).fill_null(get_second_level_domains([None])[0])
+    return data.append_column(sld_column, sld_array)
+
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description="Given a csv with hostnames, we get the second level domain and append the information")
     ap.add_argument("in_csv", help="The expected column format and names should have " + str(keyset))
@@ -21,39 +52,7 @@ if __name__ == '__main__':
 
     args = ap.parse_args()
 
-    hostname_to_sld = {}
-
-    # Read data from CSV and create in-memory object representation of that data.
-    with open(args.in_csv, "rb") as in_csv_file:
-        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
-        # row_num = 0
-        for row in csv_reader:
-            hostname = row[csv_key_hostname]
-
-
-            # turn hostname into sld
-            if hostname not in hostname_to_sld:
-                tldresult = tldextract.extract(hostname)
-                sld_new = _get_second_level_domain_from_tld(tldresult)
-                hostname_to_sld[hostname] = sld_new
-
-    # read in the file again to do the second time to label each row, and write it out as well
-    with open(args.in_csv, "rb") as in_csv_file:
-        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
-
-        with open(args.out_csv, "wb") as out_csv_file:
-            csv_writer = csv.writer(out_csv_file, encoding="utf-8")
-            csv_header = csv_reader.fieldnames + [csv_key_sld_label]
-            csv_writer.writerow(csv_header)
-
-            # row_num = 0
-            for row in csv_reader:
-                hostname = row[csv_key_hostname]
-                sld = hostname_to_sld[hostname]
-                # put into array by header order (ignoring the last column, since that is second levle domain column)
-                data_row = [row[header_name] for header_name in csv_header[0:-1]]
-
-                #add sld
-                data_row.append(sld)
-                # write row
-                csv_writer.writerow(data_row)
+    # Read every column as is, so that the other columns are written out unchanged
+    df = pd.read_csv(args.in_csv, dtype=str, keep_default_na=False)
+    append_sld(df)
+    df.to_csv(args.out_csv, index=False, encoding="utf-8")
@@ -1,7 +1,8 @@
 #!/usr/bin/python
 
 """
-Consolidates block decisions for packets in multiple NoMoAds json files in a single csv file.
+Consolidates block decisions for packets in multiple NoMoAds json files in a single csv file, with one row per packet
+or one row per flow (see aggregate_flows.py).
 """
 
 import argparse
@@ -14,6 +15,9 @@ import glob
 # utils is in parent dir
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + os.sep + "..")
 from utils import utils
+import packet_store
+import json_keys
+import aggregate_flows
 
 json_key_protocol = "protocol"
 json_key_src_ip = "src_ip"
@@ -24,77 +28,126 @@ json_key_pii_found = "pii_types"
 json_key_package_name = "package_name"
 json_key_http_body = "http.file_data"
 
+csv_key_app_store = "app_store"
+
 
 OCULUS = "oculus"
 ACCEPTED_FILE_NAMING_FORMATS = [OCULUS]
 
+# Suffixes of the annotated NoMoAds files
+FILE_SUFFIXES = ["-out-nomoads.json", "-out-nomoads" + packet_store.PARQUET_EXTENSION]
 
-def write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer, include_http_body=False):
-    with open(full_path, "r") as jf:
-        data = json.load(jf)
-        for key in data:
-            pkt = data[key]
-            protocol = pkt.get(json_key_protocol, "")
-
-            src_ip = pkt[json_key_src_ip]
-            dst_ip = pkt[json_key_dst_ip]
-            dst_port = pkt[json_key_dst_port]
-            tcp_stream = pkt[json_key_tcp_stream]
-            host = pkt.get(utils.json_key_host, "")
-            path = pkt.get(utils.json_key_uri, "")
-            piis_found = pkt.get(json_key_pii_found, "[]")
-            package_name = pkt.get(json_key_package_name, "")
-            headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
-
-            row = [app_id,
-                   key,
-                   protocol,
-                   src_ip,
-                   dst_ip,
-                   dst_port,
-                   tcp_stream,
-                   host,
-                   path,
-                   headers,
-                   piis_found,
-                   package_name]
-
-            if include_http_body:
-                row.append(pkt.get(json_key_http_body, ""))
-
-            for fl in filter_list_names:
-                row.append(pkt[fl])
-            csv_writer.writerow(row)
 
+# Columns of a Parquet packet store that end up in the CSV file, besides the block decisions
+CSV_COLUMNS = [json_key_protocol, json_key_src_ip, json_key_dst_ip, json_key_dst_port, json_key_tcp_stream,
+               utils.json_key_host, utils.json_key_uri, utils.json_key_headers, json_key_pii_found,
+               json_key_package_name]
 
-def file_naming_format(format):
-    if format not in ACCEPTED_FILE_NAMING_FORMATS:
-        raise argparse.ArgumentTypeError('Please pick a value from: ' +
-                                         ACCEPTED_FILE_NAMING_FORMATS)
-    return format
+# Columns of a Parquet packet store that are aggregated into flows, besides the block decisions
+FLOW_COLUMNS = [json_key_protocol, json_key_src_ip, json_key_dst_ip, json_key_dst_port, json_key_tcp_stream,
+                utils.json_key_host, json_key_pii_found, json_key_package_name, json_keys.version, json_keys.ts]
 
 
-if __name__ == '__main__':
-    default_file_naming_format = OCULUS
-    ap = argparse.ArgumentParser(
-        description="Consolidates block decisions for packets in multiple NoMoAds json files in a single csv file.")
-    ap.add_argument('dir', type=utils.readable_dir,
-                    help='Directory containing JSON files in NoMoAds format, annotated with block decisions.')
-    ap.add_argument('filter_list_dir', type=utils.readable_dir, help='Directory with the filter lists present in ' +
-                    'the annotated NoMoAds JSON. This directory is traversed to determine the JSON keys used for the ' +
-                    'filter lists in the NoMoAds JSON (file extensions are not part of the JSON key).')
-    ap.add_argument('csv_file', help='CSV file where the consolidated results are to be written.')
-    ap.add_argument('--format', type=file_naming_format, default=default_file_naming_format,
-                    help='File naming format, from the following list: ' +
-                         str(ACCEPTED_FILE_NAMING_FORMATS) + '. Default is ' +
-                         default_file_naming_format + '.')
-    ap.add_argument('--include_http_body', action="store_true",
-                    help='Whether to include http body')
-    args = ap.parse_args()
+def read_annotated_packets(full_path, filter_list_names, include_http_body=False, columns=None):
+    """
+    :param full_path: an annotated NoMoAds json file, or an annotated Parquet packet store, of which only the
+        columns written to the CSV file are read
+    :param columns: the columns to read from a Parquet packet store besides the block decisions, if not the ones
+        of a packet row
+    :return: a dictionary of key -> packet
+    """
+    if packet_store.is_packet_store(full_path):
+        if columns is None:
+            columns = CSV_COLUMNS + ([json_key_http_body] if include_http_body else [])
+        return packet_store.read_packets(full_path, columns=columns + filter_list_names)
+    return packet_store.read_json_packets(full_path)
+
+
+def write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer, include_http_body=False,
+                                 app_store=None):
+    """
+    Writes one row per packet of an annotated NoMoAds file.
+    :param app_store: name of the app store of the app, written in the last column; None to leave out the column
+    :return: the number of rows written
+    """
+    data = read_annotated_packets(full_path, filter_list_names, include_http_body=include_http_body)
+    for key in data:
+        pkt = data[key]
+        protocol = pkt.get(json_key_protocol, "")
+
+        src_ip = pkt[json_key_src_ip]
+        dst_ip = pkt[json_key_dst_ip]
+        dst_port = pkt[json_key_dst_port]
+        tcp_stream = pkt[json_key_tcp_stream]
+        host = pkt.get(utils.json_key_host, "")
+        path = pkt.get(utils.json_key_uri, "")
+        piis_found = pkt.get(json_key_pii_found, "[]")
+        package_name = pkt.get(json_key_package_name, "")
+        headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
+
+        row = [app_id,
+               key,
+               protocol,
+               src_ip,
+               dst_ip,
+               dst_port,
+               tcp_stream,
+               host,
+               path,
+               headers,
+               piis_found,
+               package_name]
+
+        if include_http_body:
+            row.append(pkt.get(json_key_http_body, ""))
+
+        for fl in filter_list_names:
+            row.append(pkt[fl])
 
-    # Determine the json keys used for each filter list.
+        if app_store is not None:
+            row.append(app_store)
+        csv_writer.writerow(row)
+    return len(data)
+
+
+def write_flows_to_csv(app_id, filter_list_names, full_path, csv_writer, app_store=None):
+    """
+    Writes one row per flow of an annotated NoMoAds file. A flow is blocked by a filter list if any of its packets is.
+    :param app_store: name of the app store of the app, written in the last column; None to leave out the column
+    :return: the number of rows written
+    """
+    data = read_annotated_packets(full_path, filter_list_names, columns=FLOW_COLUMNS)
+    flows = aggregate_flows.aggregate_packets(data, filter_list_names)
+    for flow_id, flow in flows.items():
+        row = [app_id,
+               flow_id,
+               flow.get(json_key_protocol, ""),
+               flow[json_key_src_ip],
+               flow[json_key_dst_ip],
+               flow[json_key_dst_port],
+               flow.get(json_key_tcp_stream, ""),
+               flow.get(utils.json_key_host, ""),
+               flow[json_key_pii_found],
+               flow.get(json_key_package_name, ""),
+               flow[json_keys.packet_count],
+               flow[json_keys.first_ts],
+               flow[json_keys.last_ts]]
+
+        for fl in filter_list_names:
+            row.append(flow[fl])
+
+        if app_store is not None:
+            row.append(app_store)
+        csv_writer.writerow(row)
+    return len(flows)
+
+
+def get_filter_list_names(filter_list_dir):
+    """
+    Determines the json keys used for each filter list: the name of its file minus the file extension.
+    """
     fl_names = []
-    for fl_file in os.listdir(args.filter_list_dir):
+    for fl_file in os.listdir(filter_list_dir):
         if "DS_Store" in fl_file:
             continue
         ext_start = fl_file.rfind(".")
@@ -109,42 +162,149 @@ if __name__ == '__main__':
         else:
             print("WARNING: skipping filter list file '" + fl_file +
                   "' as the filename is empty before the file extension")
+    return fl_names
 
-    with open(args.csv_file, "wb") as f:
-        blk = "_block_decision"
-        header_row = ["app_id",
-                      "pkt_id",
-                      json_key_protocol,
-                      json_key_src_ip,
-                      json_key_dst_ip,
-                      json_key_dst_port,
-                      "tcp_stream",
-                      "hostname",
-                      "path",
-                      "headers",
-                      json_key_pii_found,
-                      json_key_package_name]
-        if args.include_http_body:
-            header_row.append(json_key_http_body)
-
-        for fln in fl_names:
-            header_row.append(fln + blk)
 
-        csv_writer = csv.writer(f)
-        csv_writer.writerow(header_row)
+def get_header_row(filter_list_names, include_http_body=False, app_store=False):
+    """
+    :param app_store: whether the rows end with an app_store column
+    """
+    blk = "_block_decision"
+    header_row = ["app_id",
+                  "pkt_id",
+                  json_key_protocol,
+                  json_key_src_ip,
+                  json_key_dst_ip,
+                  json_key_dst_port,
+                  "tcp_stream",
+                  "hostname",
+                  "path",
+                  "headers",
+                  json_key_pii_found,
+                  json_key_package_name]
+    if include_http_body:
+        header_row.append(json_key_http_body)
+
+    for fln in filter_list_names:
+        header_row.append(fln + blk)
 
-        FILE_SUFFIX = "-out-nomoads.json"
+    if app_store:
+        header_row.append(csv_key_app_store)
+    return header_row
 
-        for fn in glob.iglob(args.dir + os.sep + "*" + FILE_SUFFIX):
-            if fn == ".DS_Store":
-                continue
-            if args.format == OCULUS:
+
+def get_flow_header_row(filter_list_names, app_store=False):
+    """
+    :param app_store: whether the rows end with an app_store column
+    """
+    blk = "_block_decision"
+    header_row = ["app_id",
+                  json_keys.flow_id,
+                  json_key_protocol,
+                  json_key_src_ip,
+                  json_key_dst_ip,
+                  json_key_dst_port,
+                  "tcp_stream",
+                  "hostname",
+                  json_key_pii_found,
+                  json_key_package_name,
+                  json_keys.packet_count,
+                  json_keys.first_ts,
+                  json_keys.last_ts]
+
+    for fln in filter_list_names:
+        header_row.append(fln + blk)
+
+    if app_store:
+        header_row.append(csv_key_app_store)
+    return header_row
+
+
+def get_annotated_files(dir, format=OCULUS):
+    """
+    :param dir: directory with annotated NoMoAds json files and/or Parquet packet stores
+    :return: a list of (app_id, path) tuples, one per annotated file in dir
+    """
+    annotated_files = []
+    for file_suffix in FILE_SUFFIXES:
+        for fn in sorted(glob.iglob(glob.escape(dir) + os.sep + "*" + file_suffix)):
+            if format == OCULUS:
                 # Assume filename format like "app.json"
                 app_id = os.path.basename(fn)
-                app_id = app_id.replace(FILE_SUFFIX,"").replace("_", ".")
+                app_id = app_id.replace(file_suffix, "").replace("_", ".")
             else:
                 # This shouldn't happen
                 print("Error: format does not match")
                 sys.exit(-1)
-            full_path = fn
-            write_block_decisions_to_csv(app_id, fl_names, full_path, csv_writer,include_http_body=args.include_http_body)
+            annotated_files.append((app_id, fn))
+    return annotated_files
+
+
+def consolidate(app_store_dirs, filter_list_names, csv_file, include_http_body=False, format=OCULUS, flows=False):
+    """
+    Streams the annotated packets of many apps into a single csv file, one annotated file at a time, so that only
+    the packets of one app are in memory at once.
+    :param app_store_dirs: a list of (app store name, list of directories with annotated files) tuples. If an app
+        store name is None, the csv file has no app_store column.
+    :param filter_list_names: the json keys of the filter lists, in the order of the csv columns
+    :param csv_file: path of the csv file to write
+    :param flows: whether to write one row per flow instead of one row per packet; http bodies are not included
+    :return: the number of rows written
+    """
+    with_app_store = any(app_store is not None for app_store, _ in app_store_dirs)
+    count = 0
+    with open(csv_file, "wb") as f:
+        csv_writer = csv.writer(f)
+        if flows:
+            csv_writer.writerow(get_flow_header_row(filter_list_names, app_store=with_app_store))
+        else:
+            csv_writer.writerow(get_header_row(filter_list_names, include_http_body, app_store=with_app_store))
+        for app_store, dirs in app_store_dirs:
+            for dir in dirs:
+                for app_id, full_path in get_annotated_files(dir, format):
+                    if flows:
+                        count += write_flows_to_csv(app_id, filter_list_names, full_path, csv_writer,
+                                                    app_store=app_store)
+                    else:
+                        count += write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer,
+                                                              include_http_body=include_http_body,
+                                                              app_store=app_store)
+    return count
+
+
+def file_naming_format(format):
+    if format not in ACCEPTED_FILE_NAMING_FORMATS:
+        raise argparse.ArgumentTypeError('Please pick a value from: ' +
+                                         ACCEPTED_FILE_NAMING_FORMATS)
+    return format
+
+
+if __name__ == '__main__':
+    default_file_naming_format = OCULUS
+    ap = argparse.ArgumentParser(
+        description="Consolidates block decisions for packets in multiple NoMoAds json files in a single csv file.")
+    ap.add_argument('dir', type=utils.readable_dirs,
+                    help='Directory containing JSON files in NoMoAds format, annotated with block decisions. ' +
+                         'Multiple directories (e.g., the results of all apps of an app store) can be given ' +
+                         'separated by ' + utils.DIR_DELIMITER + ' and are consolidated in the same csv file.')
+    ap.add_argument('filter_list_dir', type=utils.readable_dir, help='Directory with the filter lists present in ' +
+                    'the annotated NoMoAds JSON. This directory is traversed to determine the JSON keys used for the ' +
+                    'filter lists in the NoMoAds JSON (file extensions are not part of the JSON key).')
+    ap.add_argument('csv_file', help='CSV file where the consolidated results are to be written.')
+    ap.add_argument('--format', type=file_naming_format, default=default_file_naming_format,
+                    help='File naming format, from the following list: ' +
+                         str(ACCEPTED_FILE_NAMING_FORMATS) + '. Default is ' +
+                         default_file_naming_format + '.')
+    ap.add_argument('--include_http_body', action="store_true",
+                    help='Whether to include http body')
+    ap.add_argument('--app_store', type=str, default=None,
+                    help='Name of the app store of the apps, written in an additional ' + csv_key_app_store +
+                         ' column of every row.')
+    ap.add_argument('--flows', action="store_true",
+                    help='Write one row per flow, i.e., per (tcp.stream, host) of an app, with its number of packets, '
+                         'the union of their PII types, and the timestamps of its first and last packets.')
+    args = ap.parse_args()
+
+    fl_names = get_filter_list_names(args.filter_list_dir)
+    consolidate([(args.app_store, args.dir)], fl_names, args.csv_file, include_http_body=args.include_http_body,
+                format=args.format, flows=args.flows)
@@ -18,20 +18,43 @@ tshark from PCAPNG format
 # See the LICENSE.md file along with OVRseen for more details.
 
 import os, sys
+import io
 import json
-import uuid
 import argparse
+import heapq
+import itertools
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 from collections import OrderedDict
 
-from pii_helper import PIIHelper
+from pii_helper import PIIProfiles
+from merge_cap import get_tshark_cmd
 import json_keys
+import packet_store
+import pcapng_reader
 
-# Prepare PII helper
-pii_helper = PIIHelper(json_keys.PII_VALUES, json_keys.LOCATION_PII, should_redact=True)
+# Number of characters to read at a time when streaming tshark JSON
+STREAM_CHUNK_SIZE = 1 << 20
 
-# set of tuples (src port, dst IP) of decrypted connections
-decrypted_tuples = set()
+# Layers we look at when tshark is run directly on a PCAPNG file; everything else is left out of its output
+TSHARK_PIPE_LAYERS = [json_keys.frame, json_keys.pkt_comment, json_keys.ip, json_keys.tcp, json_keys.http,
+                      json_keys.ssl, json_keys.websocket, json_keys.websocketdata, json_keys.irc]
+
+# Only outgoing TCP packets that carry one of the protocols we extract are of interest
+TSHARK_PIPE_FILTER = "ip.src == " + json_keys.ANTMONITOR_SRC_IP + " && tcp && (" + \
+                     " || ".join([json_keys.http, json_keys.ssl, json_keys.websocket, json_keys.irc]) + ")"
+
+# Outgoing HTTP packets of the decrypted trace mark their connection as decrypted; only the fields that identify the
+# connection, (src port, dst IP), are needed to index them
+TSHARK_DECRYPTED_FILTER = "ip.src == " + json_keys.ANTMONITOR_SRC_IP + " && tcp && " + json_keys.http
+TSHARK_DECRYPTED_FIELDS = [json_keys.tcp + ".srcport", json_keys.ip + ".dst"]
+
+# When the TLS packets of a trace are read with pcapng_reader, tshark only has to dissect the other protocols
+TSHARK_NO_TLS_ARGS = ["--disable-protocol", json_keys.ssl]
+TSHARK_NO_TLS_FILTER = "ip.src == " + json_keys.ANTMONITOR_SRC_IP + " && tcp && (" + \
+                       " || ".join([json_keys.http, json_keys.websocket, json_keys.irc]) + ")"
 
 
 def make_unique(key, dct):
@@ -70,11 +93,24 @@ def get_tcp_stream_number(pkt):
     return int(tcp_section[json_keys.tcpstream])
 
 
-def extract_http_pkt(layers, frame_num, include_http_body=False):
+def get_packet_comment(layers):
+    '''
+    Parse the comment that AntMonitor added to a packet.
+    :param layers: a packet data from the _source.layers structure in tshark json format.
+    :return: the parsed comment (package name, version, and optionally device), or None if the packet has no comment.
+    '''
+    if (json_keys.pkt_comment not in layers or
+            json_keys.frame_comment not in layers[json_keys.pkt_comment]):
+        return None
+    return json.loads(layers[json_keys.pkt_comment][json_keys.frame_comment])
+
+
+def extract_http_pkt(layers, frame_num, pii_helper, include_http_body=False):
     '''
     Extract HTTP information from tshark json to NoMoAds json.
     :param layers: a packet data from the _source.layers structure in tshark json format.
     :param frame_num: a string containing the frame number (for std.out warnings in case something unexpected happens)
+    :param pii_helper: the PIIHelper of the device that sent the packet
     :return: A map that contains the interesting HTTP data
     '''
 
@@ -121,20 +157,13 @@ def extract_http_pkt(layers, frame_num, include_http_body=False):
     if len(new_packet[json_keys.headers].keys()) == 0:
         print("WARNING: packet has no header: ", str(http_data))
 
-    # Save PII
-    pii_found = []
-
-    # If there is a body, check it for PII. Since we don't save body data, we don't care about redacting it
-    if json_keys.http_body in http_data:
-        redacted_http_body, pii_found_in_body = pii_helper.get_pii_from_str(http_data[json_keys.http_body])
-        if include_http_body:
-            new_packet[json_keys.http_body] = redacted_http_body
-            new_packet[json_keys.http_body].strip()
-        pii_found += pii_found_in_body
-
-    # Find PII in the json data that we will share, make note of them, and redact them
-    redacted_packet, pii_found_in_headers = pii_helper.get_pii_from_data(new_packet)
-    pii_found += pii_found_in_headers
+    # Find PII in the json data that we will share, make note of them, and redact them.
+    # If there is a body, it is checked for PII as well, but only saved when asked to.
+    redacted_packet, redacted_http_body, pii_found = pii_helper.get_pii_from_packet(
+        new_packet, body=http_data.get(json_keys.http_body))
+    if redacted_http_body is not None and include_http_body:
+        redacted_packet[json_keys.http_body] = redacted_http_body
+        redacted_packet[json_keys.http_body].strip()
 
     # Save the PII
     redacted_packet[json_keys.pii_label] = pii_found
@@ -181,11 +210,12 @@ def extract_tls_pkt(layers):
     return None
 
 
-def extract_other_pkt(layers, frame_num, include_http_body=False):
+def extract_other_pkt(layers, frame_num, pii_helper, include_http_body=False):
     '''
     Extract JSON-structured information in other packets from tshark json to NoMoAds json.
     :param layers: a packet data from the _source.layers structure in tshark json format.
     :param frame_num: a string containing the frame number (for std.out warnings in case something unexpected happens)
+    :param pii_helper: the PIIHelper of the device that sent the packet
     :return: A map that contains the interesting JSON data
     '''
     # Get what we need from the packet
@@ -217,25 +247,211 @@ def extract_other_pkt(layers, frame_num, include_http_body=False):
     return new_packet
 
 
-def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
+def iter_json_array(text_file, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Incrementally parse the top-level JSON array written by tshark and yield its elements one at a time.
+    Duplicate keys are made unique the same way as when the whole file is decoded at once.
+    :param text_file: a file-like object opened in text mode that contains a JSON array.
+    :param chunk_size: number of characters to read from the file at a time.
+    :return: a generator over the elements of the array.
+    '''
+    # Since certain json 'keys' appear multiple times in our data, we have to make them
+    # unique first (we can't use regular json.load() or we lose some data points). From:
+    # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
+    decoder = json.JSONDecoder(object_pairs_hook=parse_object_pairs)
+    buf = ""
+    pos = 0
+    eof = False
+    in_array = False
+    read_size = chunk_size
+
+    while True:
+        # Skip whitespace and the separators between the array elements
+        while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ",")):
+            pos += 1
+
+        if pos < len(buf):
+            if not in_array:
+                if buf[pos] != "[":
+                    raise ValueError("tshark JSON output does not start with an array")
+                in_array = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element is not fully buffered yet
+                if eof:
+                    raise
+            else:
+                yield element
+                pos = end
+                read_size = chunk_size
+                continue
+        elif eof:
+            if in_array:
+                print("WARNING: tshark JSON output ended before the closing bracket")
+            return
+
+        # Drop what we already consumed and read more data. If a single element is larger than what we have
+        # buffered, grow the read size so that large packets do not get re-parsed too many times.
+        buf = buf[pos:]
+        pos = 0
+        chunk = text_file.read(read_size)
+        if not chunk:
+            eof = True
+        else:
+            buf += chunk
+            if len(buf) > read_size:
+                read_size *= 2
+
+
+def iter_tshark_packets(full_path):
+    '''
+    Stream the packets of a JSON file generated by tshark.
+    :param full_path: the path to the tshark JSON file.
+    :return: a generator over the packets in tshark json format.
+    '''
     with open(full_path, "rb") as jf:
-        # Since certain json 'keys' appear multiple times in our data, we have to make them
-        # unique first (we can't use regular json.load() or we lose some data points). From:
-        # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
-        decoder = json.JSONDecoder(object_pairs_hook=parse_object_pairs)
-        pcap_data = decoder.decode(jf.read().decode(errors='ignore'))
+        text_file = io.TextIOWrapper(jf, encoding="utf-8", errors="ignore")
+        yield from iter_json_array(text_file)
+
+
+def iter_tshark_pipe(pcap_file, display_filter=TSHARK_PIPE_FILTER, extra_args=()):
+    '''
+    Run tshark on a PCAPNG file and stream the packets from its output as they are dissected.
+    tshark only outputs the layers that we extract and the packets that can yield a NoMoAds packet,
+    so no intermediate JSON file is needed.
+    :param pcap_file: the path to the merged PCAPNG file.
+    :param display_filter: the packets to output.
+    :param extra_args: other tshark arguments, e.g., to disable dissectors.
+    :return: a generator over the packets in tshark json format.
+    '''
+    cmd = get_tshark_cmd(pcap_file, list(extra_args) + ["-T", "json",
+                                                        "-J", " ".join(TSHARK_PIPE_LAYERS),
+                                                        "-Y", display_filter])
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        text_file = io.TextIOWrapper(proc.stdout, encoding="utf-8", errors="ignore")
+        yield from iter_json_array(text_file)
+    finally:
+        if proc.poll() is None:
+            # We stopped reading before tshark was done (e.g., on error)
+            proc.kill()
+        proc.stdout.close()
+        ret = proc.wait()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+
+def index_decrypted_tuples_pipe(pcap_file):
+    '''
+    Quick pass over the decrypted trace that only collects the connections that were decrypted, i.e., the ones that
+    carry outgoing HTTP packets, without extracting the packets: tshark only outputs their src port and dst IP, which
+    is much quicker than dissecting the whole packets into JSON.
+    :param pcap_file: the path to the merged PCAPNG file of the decrypted trace.
+    :return: a set of (src port, dst IP) tuples.
+    '''
+    output_args = ["-T", "fields", "-E", "occurrence=f", "-Y", TSHARK_DECRYPTED_FILTER]
+    for field in TSHARK_DECRYPTED_FIELDS:
+        output_args += ["-e", field]
+    output = subprocess.check_output(get_tshark_cmd(pcap_file, output_args))
+    decrypted_tuples = set()
+    for line in output.decode("utf-8", errors="ignore").splitlines():
+        if not line:
+            continue
+        src_port, dst_ip = line.split("\t")
+        decrypted_tuples.add((int(src_port), dst_ip))
+    return decrypted_tuples
+
+
+def print_pii_cache_info(info):
+    print("PII cache: %d hits, %d misses, %d/%d entries" % (info["hits"], info["misses"], info["size"], info["max_size"]))
+
+
+def iter_nomoads_packets(full_path):
+    '''
+    Stream the packets of a NoMoAds json file written by packet_store.write_json_packets.
+    :param full_path: the path to the NoMoAds json file.
+    :return: a generator of (key, packet) tuples.
+    '''
+    with open(full_path, "r", encoding="utf-8") as jf:
+        for record in iter_json_array(jf):
+            packet = dict(record)
+            yield packet.pop(json_keys.id), packet
 
-        for packet in pcap_data:
+
+def iter_future_packets(future, full_path):
+    '''
+    :param future: the future of an Extractor.extract_trace call
+    :param full_path: the NoMoAds json file that the call writes
+    :return: a generator over the (key, packet) tuples of the file, which only waits for the future once it is
+             iterated
+    '''
+    print_pii_cache_info(future.result())
+    yield from iter_nomoads_packets(full_path)
+
+
+# Extractor of the worker process of Extractor.extract(parallel=True), built when the worker starts
+_worker_extractor = None
+
+
+def _init_worker(include_http_body, device):
+    global _worker_extractor
+    _worker_extractor = Extractor(include_http_body=include_http_body, device=device)
+
+
+def _extract_trace_in_worker(full_path, is_decrypted, out_file, decrypted_tuples, from_pcap, native_tls):
+    return _worker_extractor.extract_trace(full_path, is_decrypted, out_file, decrypted_tuples=decrypted_tuples,
+                                           from_pcap=from_pcap, native_tls=native_tls)
+
+
+class Extractor(object):
+    """
+    Converts the tshark traces of apps into NoMoAds packets. An Extractor holds its own PII helpers, whose caches stay
+    warm from one app to the next, so a single instance can extract many apps in the same process. The decrypted
+    connections of an app, and the worker process that extracts its encrypted trace in parallel, are only kept for
+    the duration of its extract() call.
+    """
+
+    def __init__(self, include_http_body=False, device=None):
+        """
+        :param include_http_body: whether to include the http body of the packets
+        :param device: name of the device that produced the traces. If None, the device is taken from the packet
+                       comments, and packets without one are searched for the PII of all devices.
+        """
+        self.include_http_body = include_http_body
+        self.device = device
+        # Prepare PII helpers, one per device
+        self.pii_profiles = PIIProfiles(json_keys.COMMON_PII_VALUES, json_keys.DEVICE_PII_VALUES,
+                                        json_keys.LOCATION_PII, should_redact=True)
+
+    def extract_packets(self, packets, is_decrypted, decrypted_tuples=None):
+        '''
+        Convert packets in tshark json format into packets in NoMoAds json format.
+        :param packets: an iterable of packets in tshark json format.
+        :param is_decrypted: whether the packets come from the decrypted trace.
+        :param decrypted_tuples: set of (src port, dst IP) tuples of decrypted connections, whose TLS packets are
+                                 skipped. The connections of the HTTP packets of the decrypted trace are added to it
+                                 as they are found. If None, a new empty set is used.
+        :return: a generator of (key, packet) tuples, where each packet is in NoMoAds json format and each key is an
+                 integer derived from the frame number of the packet (see packet_store.get_packet_id).
+        '''
+        if decrypted_tuples is None:
+            decrypted_tuples = set()
+        for packet in packets:
             layers = packet[json_keys.source][json_keys.layers]
 
-            # All captured traffic should have a frame + frame number, but check anyway
-            frame_num = " Frame: "
+            # All captured traffic should have a frame + frame number, but check anyway. The key of the packet is
+            # derived from it, and tshark may have filtered out other packets, so there is nothing to fall back on.
             if json_keys.frame not in layers or json_keys.frame_num not in layers[json_keys.frame]:
-                print("WARNING: could not find frame number! Using -1...")
-                frame_num = frame_num + "-1"
-            else:
-                # Save frame number for error-reporting
-                frame_num = frame_num + layers[json_keys.frame][json_keys.frame_num]
+                print("WARNING: could not find frame number! Skipping packet...")
+                continue
+            frame_number = layers[json_keys.frame][json_keys.frame_num]
+            # Save frame number for error-reporting
+            frame_num = " Frame: " + str(frame_number)
 
             # All captured traffic should be IP, but check anyway
             if not json_keys.ip in layers:
@@ -260,9 +476,16 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
             # in until we successfully hit the protocol (or declare that the packet is not interesting if no match).
             new_packet = None
 
+            # Only search for the PII of the device that sent the packet
+            comment_data = get_packet_comment(layers)
+            packet_device = self.device
+            if packet_device is None and comment_data is not None:
+                packet_device = comment_data.get(json_keys.device)
+            pii_helper = self.pii_profiles.get_helper(packet_device)
+
             # Check if HTTP first
             if json_keys.http in layers:
-                new_packet = extract_http_pkt(layers, frame_num, include_http_body=include_http_body)
+                new_packet = extract_http_pkt(layers, frame_num, pii_helper, include_http_body=self.include_http_body)
                 # Keep track of decrypted connections by source port and destination IP to avoid double-counting
                 if is_decrypted:
                     decrypted_tuples.add((src_port, dst_ip))
@@ -277,9 +500,11 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
                 if not json_keys.ssl in layers:
                     # We are interested in websocket and irc packets.
                     if json_keys.websocket in layers and json_keys.websocketdata in layers:
-                        new_packet = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
+                        new_packet = extract_other_pkt(layers, frame_num, pii_helper,
+                                                       include_http_body=self.include_http_body)
                     if json_keys.irc in layers:
-                        new_packet = extract_other_pkt(layers, frame_num, include_http_body=include_http_body)
+                        new_packet = extract_other_pkt(layers, frame_num, pii_helper,
+                                                       include_http_body=self.include_http_body)
                 else:
                     continue
 
@@ -296,15 +521,12 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
             if tcp_stream_id is not None:
                 new_packet[json_keys.tcpstream] = tcp_stream_id
 
-            # Extract and parse the packet comment
-            if (json_keys.pkt_comment not in layers or
-                    json_keys.frame_comment not in layers[json_keys.pkt_comment]):
+            # The packet comment was parsed above
+            if comment_data is None:
                 print("WARNING: no packet comment found!" + frame_num)
                 continue
 
             # Extract package info from comment
-            comment = layers[json_keys.pkt_comment][json_keys.frame_comment]
-            comment_data = json.loads(comment)
             new_packet[json_keys.package_name] = comment_data[json_keys.package_name]
             new_packet[json_keys.version] = comment_data[json_keys.version]
 
@@ -313,46 +535,155 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
                 print("WARNING: could not find timestamp!" + frame_num)
                 continue
 
-            new_packet["ts"] = layers[json_keys.frame][json_keys.frame_ts]
-
-            # Create a unique key for each packet to keep consistent with ReCon
-            # Also good in case packets end up in different files
-            data[str(uuid.uuid4())] = new_packet
+            new_packet[json_keys.ts] = layers[json_keys.frame][json_keys.frame_ts]
+
+            # Create a unique key for each packet to keep consistent with ReCon. The key only depends on the trace, so
+            # extracting the same traces again gives the same keys.
+            yield packet_store.get_packet_id(frame_number, is_decrypted), new_packet
+
+    def extract_native_tls_packets(self, pcap_file, decrypted_tuples):
+        '''
+        Same as extract_packets for the TLS packets of an encrypted trace, but the packets are read by pcapng_reader
+        instead of tshark.
+        :param pcap_file: the path to the merged PCAPNG file of the encrypted trace.
+        :param decrypted_tuples: set of (src port, dst IP) tuples of decrypted connections, whose TLS packets are
+                                 skipped.
+        :return: a generator of (key, packet) tuples, in the order of the trace.
+        '''
+        for client_hello in pcapng_reader.iter_client_hellos(pcap_file):
+            if client_hello.src_ip != json_keys.ANTMONITOR_SRC_IP or \
+                    (client_hello.src_port, client_hello.dst_ip) in decrypted_tuples:
+                continue
+            if client_hello.comment is None:
+                print("WARNING: no packet comment found! Frame: " + str(client_hello.frame_number))
+                continue
+            comment_data = json.loads(client_hello.comment)
 
+            new_packet = {}
+            new_packet[json_keys.host] = client_hello.server_name
+            new_packet[json_keys.protocol] = json_keys.ssl
+            new_packet[json_keys.src_ip] = client_hello.src_ip
+            new_packet[json_keys.dst_ip] = client_hello.dst_ip
+            new_packet[json_keys.dst_port] = client_hello.dst_port
+            new_packet[json_keys.tcpstream] = client_hello.tcp_stream
+            new_packet[json_keys.package_name] = comment_data[json_keys.package_name]
+            new_packet[json_keys.version] = comment_data[json_keys.version]
+            new_packet[json_keys.ts] = client_hello.ts
+            yield packet_store.get_packet_id(client_hello.frame_number, False), new_packet
+
+    def iter_trace(self, full_path, is_decrypted, decrypted_tuples=None, from_pcap=False, native_tls=False):
+        '''
+        :param from_pcap: if True, full_path is a merged PCAPNG file and tshark is run directly on it
+        :param native_tls: if True, full_path is the merged PCAPNG file of an encrypted trace, whose TLS packets are
+                           read by pcapng_reader while tshark only dissects the other protocols
+        :return: a generator of the (key, packet) tuples of a trace, see extract_packets
+        '''
+        if not native_tls:
+            read_packets = iter_tshark_pipe if from_pcap else iter_tshark_packets
+            return self.extract_packets(read_packets(full_path), is_decrypted, decrypted_tuples=decrypted_tuples)
+
+        if decrypted_tuples is None:
+            decrypted_tuples = set()
+        other_packets = self.extract_packets(
+            iter_tshark_pipe(full_path, display_filter=TSHARK_NO_TLS_FILTER, extra_args=TSHARK_NO_TLS_ARGS),
+            is_decrypted, decrypted_tuples=decrypted_tuples)
+        # Both are in the order of the trace, and keys grow with the frame number
+        return heapq.merge(other_packets, self.extract_native_tls_packets(full_path, decrypted_tuples),
+                           key=lambda key_packet: key_packet[0])
+
+    def extract_trace(self, full_path, is_decrypted, out_file, decrypted_tuples=None, from_pcap=False,
+                      native_tls=False):
+        '''
+        Extracts a whole trace to a NoMoAds json file as its packets are produced, e.g., in the worker process. See
+        iter_trace.
+        :param out_file: the NoMoAds json file to write
+        :return: the PII cache info
+        '''
+        packet_store.write_json_packets(self.iter_trace(full_path, is_decrypted, decrypted_tuples=decrypted_tuples,
+                                                        from_pcap=from_pcap, native_tls=native_tls), out_file)
+        return self.pii_profiles.cache_info()
+
+    def extract(self, tshark_file_enc, tshark_file_dec, out_file, streaming=False, from_pcap=False,
+                out_format="json", parallel=False, native_tls=False):
+        """
+        Extracts only the needed information from provided JSON packet traces and labels them
+        :param tshark_file: JSON file containing data extracted via tshark
+        :param out_file: File to write results to
+        :param streaming: if True, packets are converted and written out one at a time so that memory usage
+                          does not grow with the size of the traces
+        :param from_pcap: if True, the input files are merged PCAPNG files and tshark is run directly on them
+        :param out_format: "json" to write a NoMoAds json file, or "parquet" to write a Parquet packet store
+        :param parallel: if True, the encrypted trace is extracted in a worker process at the same time as the
+                         decrypted one, after a quick pass that indexes the decrypted connections. The worker writes
+                         its packets to a temporary file next to out_file, which is copied to out_file after the
+                         packets of the decrypted trace. Needs from_pcap.
+        :param native_tls: if True, the TLS packets of the encrypted trace are read by pcapng_reader instead of
+                           tshark; needs from_pcap
+        :return: True on success, False on failure
+        """
+
+        if not (os.path.isfile(tshark_file_enc) or os.path.isfile(tshark_file_dec)):
+            print("ERROR: invalid argument")
+            return False
+        if native_tls and not from_pcap:
+            print("ERROR: reading the TLS packets natively needs the merged PCAPNG files")
+            return False
+        if parallel and not from_pcap:
+            # Indexing the decrypted connections of a tshark JSON file means reading the whole file twice
+            print("WARNING: parallel extraction needs the merged PCAPNG files, extracting the traces one at a time")
+            parallel = False
+
+        executor = None
+        enc_file = None
+        try:
+            if parallel:
+                # The encrypted trace skips the TLS packets of decrypted connections, so these have to be known
+                # up front
+                decrypted_tuples = index_decrypted_tuples_pipe(tshark_file_dec)
+                fd, enc_file = tempfile.mkstemp(suffix=".json", prefix=".enc-",
+                                                dir=os.path.dirname(os.path.abspath(out_file)))
+                os.close(fd)
+                executor = ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                               initargs=(self.include_http_body, self.device))
+                enc_packets = iter_future_packets(executor.submit(_extract_trace_in_worker, tshark_file_enc, False,
+                                                                  enc_file, decrypted_tuples, from_pcap, native_tls),
+                                                  enc_file)
+                dec_tuples = None
+            else:
+                # The decrypted trace is fully consumed before the encrypted one is opened, so connections
+                # that were decrypted are known by the time we look at the encrypted packets
+                dec_tuples = set()
+                enc_packets = self.iter_trace(tshark_file_enc, False, decrypted_tuples=dec_tuples, from_pcap=from_pcap,
+                                              native_tls=native_tls)
+            dec_packets = self.iter_trace(tshark_file_dec, True, decrypted_tuples=dec_tuples, from_pcap=from_pcap)
+            packets = itertools.chain(dec_packets, enc_packets)
+
+            if not streaming:
+                # Prepare new data structure for re-formatted JSON storage
+                packets = list(dict(packets).items())
+
+            if out_format == "parquet":
+                packet_store.write_packets(packets, out_file)
+            else:
+                packet_store.write_json_packets(packets, out_file)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if enc_file is not None and os.path.isfile(enc_file):
+                os.remove(enc_file)
+        print_pii_cache_info(self.pii_profiles.cache_info())
 
-def write_data(data, file_out, permission):
-    # Write the new data
-    with open(file_out, permission) as jf:
-        # print json.dumps(data, sort_keys=True, indent=4)
-        jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
-        jf.truncate()
+        return True
 
 
-def extract(tshark_file_enc, tshark_file_dec, out_file, **kwargs):
+def extract(tshark_file_enc, tshark_file_dec, out_file, streaming=False, from_pcap=False, out_format="json",
+            parallel=False, native_tls=False, include_http_body=False, device=None):
     """
-    Extracts only the needed information from provided JSON packet traces and labels them
-    :param tshark_file: JSON file containing data extracted via tshark
-    :param out_file: File to write results to
-    :return: True on success, False on failure
+    Extracts the traces of one app with a new Extractor, see Extractor.extract
     """
-
-    if not (os.path.isfile(tshark_file_enc) or os.path.isfile(tshark_file_dec)):
-        print("ERROR: invalid argument")
-        return False
-
-    # Prepare new data structure for re-formatted JSON storage
-    data = {}
-
-    # Extract decrypted data first to know which connections were successfully decrypted
-    extract_from_tshark(tshark_file_dec, data, True, **kwargs)
-
-    # Extract encrypted data next
-    extract_from_tshark(tshark_file_enc, data, False, **kwargs)
-
-    write_data(data, out_file, "w")
-
-    return True
+    extractor = Extractor(include_http_body=include_http_body, device=device)
+    return extractor.extract(tshark_file_enc, tshark_file_dec, out_file, streaming=streaming, from_pcap=from_pcap,
+                             out_format=out_format, parallel=parallel, native_tls=native_tls)
 
 
 if __name__ == '__main__':
@@ -365,6 +696,23 @@ if __name__ == '__main__':
                     help='Output file')
     ap.add_argument('--include_http_body', action="store_true",
                     help='Whether to include http body')
+    ap.add_argument('--streaming', action="store_true",
+                    help='Parse the tshark JSON files incrementally and write packets as they are extracted')
+    ap.add_argument('--out_format', choices=["json", "parquet"], default="json",
+                    help='Write a NoMoAds json file (default), or a Parquet packet store (needs pyarrow)')
+    ap.add_argument('--device', choices=sorted(json_keys.DEVICE_PII_VALUES),
+                    help='Device that produced the traces; by default it is read from the packet comments')
+    ap.add_argument('--from_pcap', action="store_true",
+                    help='The input files are merged PCAPNG files: run tshark on them and read its output '
+                         'directly instead of reading intermediate JSON files')
+    ap.add_argument('--parallel', action="store_true",
+                    help='Extract the encrypted and the decrypted trace at the same time, in two processes; '
+                         'needs --from_pcap')
+    ap.add_argument('--native_tls', action="store_true",
+                    help='Read the TLS packets of the encrypted trace with pcapng_reader.py instead of tshark; '
+                         'needs --from_pcap')
     args = ap.parse_args()
 
-    extract(args.enc_file, args.dec_file, args.out_file, include_http_body=args.include_http_body)
+    extract(args.enc_file, args.dec_file, args.out_file, streaming=args.streaming, from_pcap=args.from_pcap,
+            out_format=args.out_format, parallel=args.parallel, native_tls=args.native_tls,
+            include_http_body=args.include_http_body, device=args.device)
@@ -1,12 +1,16 @@
 import os
-from adblockparser import AdblockRules
 import argparse
-import json
 import re
 import glob
+import sqlite3
+import multiprocessing
+from functools import lru_cache
 from urllib.parse import urlsplit
 
 from utils import utils
+import packet_store
+from filter_list_engine import load_filter_lists, FilterListEngine, CONTENT_TYPES, get_options_index, \
+    options_from_index
 
 key_referer = "referer"
 key_req_with = "x-requested-with"
@@ -15,32 +19,16 @@ key_xml_http_req = "xmlhttprequest"
 key_http = "http"
 key_https = "https"
 
-type_other = 'other'
-type_script = 'script'
-type_stylesheet = 'stylesheet'
-type_image = 'image'
-type_subdocument = 'subdocument'
+type_other, type_script, type_stylesheet, type_image, type_subdocument = CONTENT_TYPES
 
-# Patterns for matching URL to find content type (based on AdblockPlus for Android)
-# Note: match these against the URL path only, without including URL query and fragment
-re_js = re.compile("\.js$", re.IGNORECASE)
-re_css = re.compile("\.css$", re.IGNORECASE)
-re_image = re.compile("\.(?:gif|png|jpe?g|bmp|ico)$", re.IGNORECASE)
-re_html = re.compile("\.html?$", re.IGNORECASE)
+# Pattern for matching URL to find content type (based on AdblockPlus for Android): group i matches the extensions of
+# content type CONTENT_TYPES[i], i.e., script, stylesheet, image, and subdocument; no match means other.
+# Note: match this against the URL path only, without including URL query and fragment
+re_content_type = re.compile(r"\.(?:(js)|(css)|(gif|png|jpe?g|bmp|ico)|(html?))$", re.IGNORECASE)
 
 # The Android code also includes fonts, but based on https://adblockplus.org/en/filters#options
 # this is not a valid option in current ABP
 # re_font = re.compile("\.(?:ttf|woff)$", re.IGNORECASE)
-def init_rule_checker(filter_list_file):
-    """
-    Initializer an AdblockRules instance to correspond to a filter list stored in a given file.
-    :param filter_list_file: The path to the filter list file.
-    :return: An AdblockRules instance initialized to perform matching against the given filter list.
-    """
-    print("Reading in filter list: %s" % filter_list_file)
-    with open(filter_list_file, "r") as f:
-        lines = f.readlines()
-        return AdblockRules(lines)
 
 
 def get_content_type(url_parsed):
@@ -52,20 +40,18 @@ def get_content_type(url_parsed):
         src/org/adblockplus/libadblockplus/android/webview/AdblockWebView.java
 
     :param url_parsed: The parsed URL, as returned by urlsplit
-    :return: Content type as a string object that can be used in AdblockRules options
+    :return: Content type as a string object that can be used in filter list options
     """
-    url_path = url_parsed.path
-    type = type_other
-    if re_js.search(url_path):
-        type = type_script
-    elif re_css.search(url_path):
-        type = type_stylesheet
-    elif re_image.search(url_path):
-        type = type_image
-    elif re_html.search(url_path):
-        type = type_subdocument
+    return CONTENT_TYPES[get_content_type_index(url_parsed)]
+
 
-    return type
+def get_content_type_index(url_parsed):
+    """
+    :param url_parsed: The parsed URL, as returned by urlsplit
+    :return: The index of the content type of the URL in CONTENT_TYPES
+    """
+    match = re_content_type.search(url_parsed.path)
+    return match.lastindex if match else 0
 
 
 def get_origin(url_parsed):
@@ -82,6 +68,12 @@ def get_origin(url_parsed):
     return url_parsed.scheme + url_parsed.netloc
 
 
+@lru_cache(maxsize=65536)
+def get_referer_origin(referer):
+    # The same referers come back in many packets
+    return get_origin(urlsplit(referer))
+
+
 def isxmlreq_isthirdparty(url_parsed, httpheaders):
     """
     Parses the HTTP headers to find if the request is an xml request and if it's 3rd party
@@ -96,7 +88,7 @@ def isxmlreq_isthirdparty(url_parsed, httpheaders):
     for key in httpheaders:
         lower_key = key.lower()
         if lower_key == key_referer:
-            if get_origin(urlsplit(httpheaders[key])) != get_origin(url_parsed):
+            if get_referer_origin(httpheaders[key]) != get_origin(url_parsed):
                 is_third_party = True
         elif lower_key == key_req_with:
             if httpheaders[key].lower() == key_xml_http_req:
@@ -115,14 +107,29 @@ def get_options(url, httpheaders):
     :return: a dictionary of options that can be passed to rules.should_block
     """
 
-    url_parsed = urlsplit(url)
-    content_type = get_content_type(url_parsed)
-    (is_xml_request, is_third_party) = isxmlreq_isthirdparty(url_parsed, httpheaders)
+    return options_from_index(get_compact_options(urlsplit(url), httpheaders))
+
 
-    return {content_type: True, 'xmlhttprequest': is_xml_request, 'third-party': is_third_party}
+def get_compact_options(url_parsed, httpheaders):
+    """
+    Returns the AbblockPlus options to be set for the provided URL and HTTP headers as an options index, which is
+    cheaper to build, to use as a cache key, and to match than a dictionary of options.
+
+    :param url_parsed: The parsed URL, as returned by urlsplit
+    :param httpheaders: HTTP headers in dictionary format, where each key is the HTTP header key,
+        and each value is the HTTP header value
+    :return: an options index (see filter_list_engine.get_options_index)
+    """
+    (is_xml_request, is_third_party) = isxmlreq_isthirdparty(url_parsed, httpheaders)
+    return get_options_index(get_content_type_index(url_parsed), is_xml_request, is_third_party)
 
 
-def get_url_and_options(pkt_nomoads_json):
+def get_url_and_options(pkt_nomoads_json, compact=False):
+    """
+    :param pkt_nomoads_json: A single packet in NoMoAds JSON format.
+    :param compact: whether to return the options as an options index instead of a dictionary
+    :return: a tuple - (the URL of the packet, its options)
+    """
     port = pkt_nomoads_json[utils.json_key_dst_port]
 
     # Note: usually we only deal with HTTP/S:
@@ -136,7 +143,9 @@ def get_url_and_options(pkt_nomoads_json):
 
     url += pkt_nomoads_json[utils.json_key_host] + pkt_nomoads_json.get(utils.json_key_uri, "")
     headers = pkt_nomoads_json.get(utils.json_key_headers, {})
-    options = get_options(url, headers)
+    options = get_compact_options(urlsplit(url), headers)
+    if not compact:
+        options = options_from_index(options)
 
     return url, options
 
@@ -144,8 +153,9 @@ def get_url_and_options(pkt_nomoads_json):
 def get_block_decision(ruleset, pkt_nomoads_json, url, options):
     """
     Given a single packet in NoMoAds JSON format, return if the given filter list blocks that packet.
-    :param ruleset: an AdblockRules instance that has been initialized with a given set of rules.
+    :param ruleset: a FilterListEngine (or AdblockRules) instance that has been initialized with a given set of rules.
     :param pkt_nomoads_json: A single packet in NoMoAds JSON format.
+    :param options: A dictionary of options, or an options index.
     :return: True if the ruleset would block the packet, False otherwise.
     """
 
@@ -153,70 +163,178 @@ def get_block_decision(ruleset, pkt_nomoads_json, url, options):
     if utils.json_key_host not in pkt_nomoads_json:
         return False
 
+    # Only our own engine knows about options indexes
+    if isinstance(options, int) and not isinstance(ruleset, FilterListEngine):
+        options = options_from_index(options)
     return ruleset.should_block(url, options)
 
 
+# Columns of a Parquet packet store that are needed for matching
+MATCHING_COLUMNS = [utils.json_key_host, utils.json_key_uri, utils.json_key_headers, utils.json_key_dst_port]
+
+
 def read_nomoads_json(nomoads_json_file):
     """
     Reads a json file in NoMoAds format into memory.
-    :param nomoads_json_file: The full path to the NoMoAds json file.
+    :param nomoads_json_file: The full path to the NoMoAds json file, or to a Parquet packet store, of which only the
+        columns needed for matching are read.
     :return: The in-memory representation of the json file.
     """
-    with open(nomoads_json_file, "r") as jf:
-        #decoder = json.JSONDecoder()
-        #return decoder.decode(jf.read())
-        return json.load(jf)
+    if packet_store.is_packet_store(nomoads_json_file):
+        return packet_store.read_packets(nomoads_json_file, columns=MATCHING_COLUMNS)
+    return packet_store.read_json_packets(nomoads_json_file)
 
 
 def read_and_annotate_nomoads_json(ruleset, nomoads_json_file, filter_list_name):
     """
-    Opens a JSON file that contains packets in NoMoAds format, and annotates each packet with the given AdblockRules'
+    Opens a JSON file that contains packets in NoMoAds format, and annotates each packet with the given filter list's
     block decision. This is merely a utility function that handles reading the json file into memory on behalf of the
     caller and then internally delegates to annotate_nomoads_json.
-    :param ruleset: An AdblockRules instance that determines if each individual packet should be blocked or not.
+    :param ruleset: A FilterListEngine instance that determines if each individual packet should be blocked or not.
     :param nomoads_json_file: A JSON file with packets in NoMoAds format.
     :param filter_list_name: The key that will point to the block decision in the annotated json.
     :return: The original JSON, annotated with blocking decision and filter list name.
     """
-    with open(nomoads_json_file, "r") as jf:
-        decoder = json.JSONDecoder()
-        root_obj = decoder.decode(jf.read())
-        return annotate_nomoads_json(ruleset, root_obj, filter_list_name)
+    root_obj = read_nomoads_json(nomoads_json_file)
+    return annotate_nomoads_json(ruleset, root_obj, filter_list_name)
 
 
-block_decision_cache = dict()
+class BlockDecisionCache(object):
+    """
+    Block decisions of filter lists, by filter list and request (URL and options). Decisions are kept in memory and,
+    if a database file is given, in SQLite so that later runs (e.g., for other app stores) can reuse them.
+    Filter lists are identified by the digest of their contents, so editing a list only invalidates its own decisions.
+    """
 
-def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name):
+    # Number of new decisions to buffer before writing them to the database
+    FLUSH_SIZE = 10000
+    # Seconds to wait for another process to release the database
+    LOCK_TIMEOUT = 600
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: path of the SQLite database file (created if needed), or None to only cache in memory
+        """
+        # filter list digest -> {request key: blocked}
+        self.decisions = {}
+        self.pending = []
+        self.db = None
+        if db_path is not None:
+            # Several worker processes may share the database: let readers and one writer work concurrently,
+            # and wait for the lock instead of failing
+            self.db = sqlite3.connect(db_path, timeout=BlockDecisionCache.LOCK_TIMEOUT)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS filter_lists (name TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS decisions (digest TEXT NOT NULL, request TEXT NOT NULL, "
+                            "blocked INTEGER NOT NULL, PRIMARY KEY (digest, request)) WITHOUT ROWID")
+            self.db.commit()
+
+
+    def register_filter_list(self, name, digest):
+        """
+        Records the current digest of a filter list, and drops the decisions made with its previous contents.
+        """
+        if self.db is None:
+            return
+        row = self.db.execute("SELECT digest FROM filter_lists WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] != digest:
+            print("Filter list %s changed, dropping its cached block decisions" % name)
+            self.db.execute("DELETE FROM decisions WHERE digest = ? AND NOT EXISTS "
+                            "(SELECT 1 FROM filter_lists WHERE digest = ? AND name != ?)", (row[0], row[0], name))
+        self.db.execute("INSERT OR REPLACE INTO filter_lists (name, digest) VALUES (?, ?)", (name, digest))
+        self.db.commit()
+
+
+    def get(self, digest, request_key):
+        """
+        :return: the cached block decision, or None if there is none
+        """
+        decisions = self.decisions.setdefault(digest, {})
+        blocked = decisions.get(request_key)
+        if blocked is None and self.db is not None:
+            row = self.db.execute("SELECT blocked FROM decisions WHERE digest = ? AND request = ?",
+                                  (digest, request_key)).fetchone()
+            if row is not None:
+                blocked = decisions[request_key] = bool(row[0])
+        return blocked
+
+
+    def put(self, digest, request_key, blocked):
+        self.decisions.setdefault(digest, {})[request_key] = blocked
+        if self.db is not None:
+            self.pending.append((digest, request_key, 1 if blocked else 0))
+            if len(self.pending) >= BlockDecisionCache.FLUSH_SIZE:
+                self.flush()
+
+
+    def flush(self):
+        """
+        Writes the buffered decisions to the database.
+        """
+        if self.db is not None and self.pending:
+            self.db.executemany("INSERT OR REPLACE INTO decisions (digest, request, blocked) VALUES (?, ?, ?)",
+                                self.pending)
+            self.db.commit()
+            self.pending = []
+
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+block_decision_cache = BlockDecisionCache()
+
+def get_block_decisions(ruleset, nomoads_json, filter_list_name, filter_list_digest=None):
     """
-    Given an in-memory representation of a NoMoAds json file, annotates each packet with the given AdblockRules' block
-    decision. The filter_list_name parameter defines the key that will point to the block decision.
-    :param ruleset: An AdblockRules instance that determines if each individual packet should be blocked or not.
+    Given an in-memory representation of a NoMoAds json file, returns the given filter list's block decision for each
+    packet.
+    :param ruleset: A FilterListEngine instance that determines if each individual packet should be blocked or not.
     :param nomoads_json: An in-memory representation of a NoMoAds json file.
-    :param filter_list_name: The key that will point to the block decision in the annotated json.
-    :return: The original JSON, annotated with block decision.
+    :param filter_list_name: The name of the filter list.
+    :param filter_list_digest: The digest of the contents of the filter list, used to cache the block decisions.
+        If None, decisions are cached by filter list name, in memory only.
+    :return: A dictionary of packet key -> 1 if the packet is blocked, 0 otherwise.
     """
-    if filter_list_name not in block_decision_cache:
-        block_decision_cache[filter_list_name] = dict()
+    cache_key = filter_list_digest if filter_list_digest is not None else "name:" + filter_list_name
 
-    annotated = {}
+    decisions = {}
     for key in nomoads_json:
         pkt = nomoads_json[key]
         if utils.json_key_host in pkt:
-            url, options = get_url_and_options(pkt)
-            url_options_key = url + json.dumps(options, sort_keys=True)
-            if url_options_key in block_decision_cache[filter_list_name]:
-                blocked = block_decision_cache[filter_list_name][url_options_key]
-                #print("Found in cache: ", url_options_key)
-            else:
+            url, options = get_url_and_options(pkt, compact=True)
+            url_options_key = "%d %s" % (options, url)
+            blocked = block_decision_cache.get(cache_key, url_options_key)
+            if blocked is None:
                 blocked = get_block_decision(ruleset, pkt, url, options)
                 # add to cache
-                url_options_key = url + json.dumps(options, sort_keys=True)
-                block_decision_cache[filter_list_name][url_options_key] = blocked
+                block_decision_cache.put(cache_key, url_options_key, blocked)
         else:
             blocked = False
             #print("Warning, pkt has no ", utils.json_key_host, ", defaulting to blocked = False\n", str(pkt))
 
-        pkt[filter_list_name] = 1 if blocked else 0
+        decisions[key] = 1 if blocked else 0
+
+    return decisions
+
+
+def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name, filter_list_digest=None):
+    """
+    Given an in-memory representation of a NoMoAds json file, annotates each packet with the given filter list's block
+    decision. The filter_list_name parameter defines the key that will point to the block decision.
+    :param ruleset: A FilterListEngine instance that determines if each individual packet should be blocked or not.
+    :param nomoads_json: An in-memory representation of a NoMoAds json file.
+    :param filter_list_name: The key that will point to the block decision in the annotated json.
+    :param filter_list_digest: see get_block_decisions
+    :return: The original JSON, annotated with block decision.
+    """
+    decisions = get_block_decisions(ruleset, nomoads_json, filter_list_name, filter_list_digest)
+    annotated = {}
+    for key in nomoads_json:
+        pkt = nomoads_json[key]
+        pkt[filter_list_name] = decisions[key]
         annotated[key] = pkt
 
     return annotated
@@ -228,47 +346,18 @@ def write_annotated_nomoads_json(data, file_out):
     :param data: The annotated NoMoAds JSON.
     :param file_out: The file to output the annotated NoMoAds JSON to.
     """
-    with open(file_out, "w") as jf:
-        jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
-        jf.truncate()
+    packet_store.write_json_packets(data.items(), file_out)
 
 
-if __name__ == '__main__':
-    ap = argparse.ArgumentParser(description="Match packet data against a given set of filter lists.")
-    ap.add_argument('nomoads_dirs', type=utils.readable_dirs,
-                    help='Directories containing JSON files in NoMoAds JSON format.')
-    ap.add_argument('filter_list_dir', type=utils.readable_dir,
-                    help='Path to a directory containing filter lists in EasyList (ABP) format.')
-    ap.add_argument('out_dir_name', type=str,
-                    help='Name of the inner directory we want to save the file to.')
-    args = ap.parse_args()
-
-    # Prepare a filter list matcher for each filter list. List will contain a tuple for each filter list, with the first
-    # element being the name and the second element the matcher object.
-    fl_matchers = []
-    for fl_file in os.listdir(args.filter_list_dir):
-        if "DS_Store" in fl_file:
-            continue
-        fl_path = args.filter_list_dir + "/" + fl_file
-        ext_start = fl_file.rfind(".")
-        if ext_start < 0:
-            print("WARNING: skipping filter list file '" + fl_file +
-                  "' as the filename does not contain a file extension.")
-            continue
-        # Name of filter list becomes filename minus file extension
-        fl_name = fl_file[0:ext_start]
-        if len(fl_file) > 0:
-            try:
-                fl_matchers.append((fl_name, init_rule_checker(fl_path)))
-            except Exception as e:
-                print("Could not parse rule file: %s" % fl_path)
-                print(e)
-
-    # Now match each input json file against each filter list
-    for valid_dir in args.nomoads_dirs:
+def get_nomoads_files(nomoads_dirs):
+    """
+    :param nomoads_dirs: Directories containing JSON files in NoMoAds JSON format.
+    :return: a generator of (directory, NoMoAds json file) tuples
+    """
+    for valid_dir in nomoads_dirs:
         print("Processing: ", valid_dir)
-        for nomoads_file in glob.iglob(valid_dir + os.sep + "*-nomoads.json"):
+        for nomoads_file in sorted(glob.glob(valid_dir + os.sep + "*-nomoads.json") +
+                                   glob.glob(valid_dir + os.sep + "*-nomoads" + packet_store.PARQUET_EXTENSION)):
             print("Found nomoads json ", nomoads_file)
             nomoads_path = nomoads_file
             if nomoads_file == ".DS_Store":
@@ -276,16 +365,143 @@ if __name__ == '__main__':
             if os.path.isdir(nomoads_path):
                 # Skip sub dirs.
                 continue
-            # Load json file into memory.
+            yield valid_dir, nomoads_path
+
+
+def write_annotated_file(nomoads_json, valid_dir, nomoads_path, out_dir_name, filter_list_names):
+    # make the output directory
+    fl_result_dir = os.path.join(valid_dir, out_dir_name)
+    if not os.path.isdir(fl_result_dir):
+        os.makedirs(fl_result_dir, exist_ok=True)
+    #print("Writing to ", fl_result_dir)
+    # Json has now been annotated with blocking decisions for all filter lists. Write result to output dir.
+    out_path = fl_result_dir + os.sep + os.path.basename(nomoads_path)
+    if packet_store.is_packet_store(nomoads_path):
+        # Add one column per filter list to a copy of the packet store
+        packet_store.add_columns(nomoads_path, out_path,
+                                 [(fl_name, [pkt[fl_name] for pkt in nomoads_json.values()])
+                                  for fl_name in filter_list_names], column_type="int8")
+    else:
+        write_annotated_nomoads_json(nomoads_json, out_path)
+
+
+def annotate_files(fl_matchers, nomoads_dirs, out_dir_name):
+    """
+    Matches each NoMoAds json file against each filter list, one after the other.
+    :param fl_matchers: list of FilterList tuples, as returned by load_filter_lists
+    :param nomoads_dirs: Directories containing JSON files in NoMoAds JSON format.
+    :param out_dir_name: Name of the inner directory we want to save the annotated files to.
+    """
+    for valid_dir, nomoads_path in get_nomoads_files(nomoads_dirs):
+        # Load json file into memory.
+        nomoads_json = read_nomoads_json(nomoads_path)
+        # Perform rule matching for all filter lists.
+        for fl_tup in fl_matchers:
+            nomoads_json = annotate_nomoads_json(fl_tup.rules, nomoads_json, fl_tup.name, fl_tup.digest)
+        write_annotated_file(nomoads_json, valid_dir, nomoads_path, out_dir_name,
+                             [fl_tup.name for fl_tup in fl_matchers])
+
+
+# Set in the parent process before the worker pool is forked, so the workers share the loaded filter lists
+_worker_fl_matchers = []
+# The NoMoAds json file last read by a worker, as a (path, json) tuple
+_worker_nomoads_json = (None, None)
+
+
+def _init_worker(cache_db):
+    global block_decision_cache
+    # Each worker needs its own connection to the cache database
+    block_decision_cache = BlockDecisionCache(cache_db)
+
+
+def _match_file_against_list(task):
+    """
+    Matches one NoMoAds json file against one filter list in a worker process.
+    :param task: a (NoMoAds json file, index of the filter list in _worker_fl_matchers) tuple
+    :return: a tuple - (NoMoAds json file, filter list name, block decisions by packet key)
+    """
+    global _worker_nomoads_json
+    nomoads_path, fl_index = task
+    # Tasks of the same file usually follow each other, so keep the last file in memory
+    if _worker_nomoads_json[0] != nomoads_path:
+        _worker_nomoads_json = (nomoads_path, read_nomoads_json(nomoads_path))
+    fl_tup = _worker_fl_matchers[fl_index]
+    decisions = get_block_decisions(fl_tup.rules, _worker_nomoads_json[1], fl_tup.name, fl_tup.digest)
+    block_decision_cache.flush()
+    return nomoads_path, fl_tup.name, decisions
+
+
+def annotate_files_parallel(fl_matchers, nomoads_dirs, out_dir_name, jobs, cache_db=None):
+    """
+    Matches each NoMoAds json file against each filter list, spreading the (file, filter list) pairs over a pool of
+    worker processes. The workers are forked after the filter lists are loaded, so they do not load them again.
+    Each annotated file is written as soon as it was matched against all filter lists.
+    :param fl_matchers: list of FilterList tuples, as returned by load_filter_lists
+    :param nomoads_dirs: Directories containing JSON files in NoMoAds JSON format.
+    :param out_dir_name: Name of the inner directory we want to save the annotated files to.
+    :param jobs: number of worker processes
+    :param cache_db: SQLite file in which block decisions are cached, or None
+    """
+    global _worker_fl_matchers
+    if not fl_matchers:
+        annotate_files(fl_matchers, nomoads_dirs, out_dir_name)
+        return
+    _worker_fl_matchers = fl_matchers
+    nomoads_files = list(get_nomoads_files(nomoads_dirs))
+
+    # SQLite connections must not be shared with forked processes
+    block_decision_cache.close()
+
+    # Decisions received so far, by file
+    received = {nomoads_path: {} for _, nomoads_path in nomoads_files}
+    dirs = {nomoads_path: valid_dir for valid_dir, nomoads_path in nomoads_files}
+    tasks = [(nomoads_path, fl_index) for _, nomoads_path in nomoads_files for fl_index in range(len(fl_matchers))]
+
+    with multiprocessing.get_context("fork").Pool(jobs, initializer=_init_worker, initargs=(cache_db,)) as pool:
+        for nomoads_path, fl_name, decisions in pool.imap_unordered(_match_file_against_list, tasks):
+            received[nomoads_path][fl_name] = decisions
+            if len(received[nomoads_path]) < len(fl_matchers):
+                continue
+
+            # All filter lists are done for this file: annotate it like annotate_files does, and write it
             nomoads_json = read_nomoads_json(nomoads_path)
-            # Perform rule matching for all filter lists.
             for fl_tup in fl_matchers:
-                nomoads_json = annotate_nomoads_json(fl_tup[1], nomoads_json, fl_tup[0])
-
-            # make the output directory
-            fl_result_dir = os.path.join(valid_dir, args.out_dir_name)
-            if not os.path.isdir(fl_result_dir):
-                os.makedirs(fl_result_dir)
-            #print("Writing to ", fl_result_dir)
-            # Json has now been annotated with blocking decisions for all filter lists. Write result to output dir.
-            write_annotated_nomoads_json(nomoads_json, fl_result_dir + os.sep + os.path.basename(nomoads_path))
+                fl_decisions = received[nomoads_path][fl_tup.name]
+                for key in nomoads_json:
+                    nomoads_json[key][fl_tup.name] = fl_decisions[key]
+            write_annotated_file(nomoads_json, dirs[nomoads_path], nomoads_path, out_dir_name,
+                                 [fl_tup.name for fl_tup in fl_matchers])
+            del received[nomoads_path]
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Match packet data against a given set of filter lists.")
+    ap.add_argument('nomoads_dirs', type=utils.readable_dirs,
+                    help='Directories containing JSON files in NoMoAds JSON format.')
+    ap.add_argument('filter_list_dir', type=utils.readable_dir,
+                    help='Path to a directory containing filter lists in EasyList (ABP) format.')
+    ap.add_argument('out_dir_name', type=str,
+                    help='Name of the inner directory we want to save the file to.')
+    ap.add_argument('--engine', choices=["token", "adblockparser"], default="token",
+                    help='Matching engine: the token-indexed engine (default), or adblockparser, which is much '
+                         'slower but can be used to cross-check results')
+    ap.add_argument('--cache_db', type=str, default=None,
+                    help='SQLite file in which block decisions are cached across runs')
+    ap.add_argument('--jobs', type=int, default=1,
+                    help='Number of worker processes that match files against filter lists (default: 1)')
+    args = ap.parse_args()
+
+    # Prepare a filter list matcher for each filter list. List will contain a tuple for each filter list, with the
+    # name, the matcher object, and the digest of the filter list file.
+    fl_matchers = load_filter_lists(args.filter_list_dir, engine=args.engine)
+
+    if args.cache_db is not None:
+        block_decision_cache = BlockDecisionCache(args.cache_db)
+        for fl_tup in fl_matchers:
+            block_decision_cache.register_filter_list(fl_tup.name, fl_tup.digest)
+
+    if args.jobs > 1:
+        annotate_files_parallel(fl_matchers, args.nomoads_dirs, args.out_dir_name, args.jobs, args.cache_db)
+    else:
+        annotate_files(fl_matchers, args.nomoads_dirs, args.out_dir_name)
+    block_decision_cache.close()
@@ -0,0 +1,436 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Token-indexed matching of URLs against filter lists in EasyList (ABP) format.
+
+Every rule is indexed by one token (a run of letters, digits and '%') that any URL it matches must contain as a whole
+token. To match a URL, only the rules indexed by the tokens of the URL (and the few rules that have no such token) are
+checked, instead of all rules of the list.
+
+The rules are parsed, and block decisions are made, exactly like adblockparser 0.7 does with its default settings
+(AdblockRules(lines)), so both give the same results for the same options.
+"""
+
+import os
+import re
+import hashlib
+from collections import namedtuple
+
+
+class FilterListParsingError(ValueError):
+    pass
+
+
+# Requests can also be described by a compact options index instead of a dictionary of options: the index encodes
+# the content type of the request, and whether it is an XMLHttpRequest and a third-party request.
+CONTENT_TYPES = ["other", "script", "stylesheet", "image", "subdocument"]
+OPTIONS_INDEX_COUNT = len(CONTENT_TYPES) * 4
+
+
+def get_options_index(content_type_index, is_xml_request, is_third_party):
+    """
+    :param content_type_index: index of the content type of the request in CONTENT_TYPES
+    :return: the options index of a request
+    """
+    return content_type_index * 4 + (2 if is_xml_request else 0) + (1 if is_third_party else 0)
+
+
+def options_from_index(options_index):
+    """
+    :return: the dictionary of options that corresponds to an options index
+    """
+    return {CONTENT_TYPES[options_index >> 2]: True,
+            "xmlhttprequest": bool(options_index & 2),
+            "third-party": bool(options_index & 1)}
+
+
+class FilterRule(object):
+    """
+    A single rule of a filter list, parsed like adblockparser.AdblockRule.
+    """
+
+    BINARY_OPTIONS = [
+        "script",
+        "image",
+        "stylesheet",
+        "object",
+        "xmlhttprequest",
+        "object-subrequest",
+        "subdocument",
+        "document",
+        "elemhide",
+        "other",
+        "background",
+        "xbl",
+        "ping",
+        "dtd",
+        "media",
+        "third-party",
+        "match-case",
+        "collapse",
+        "donottrack",
+        "websocket",
+    ]
+    SUPPORTED_OPTIONS = frozenset(BINARY_OPTIONS + ["domain"])
+    OPTIONS_SPLIT_RE = re.compile(",(?=~?(?:%s))" % "|".join(BINARY_OPTIONS + ["domain"]))
+
+    REGEX_SPECIAL_CHARS_RE = re.compile(r"([.$+?{}()\[\]\\])")
+    INNER_PIPE_RE = re.compile(r"(\|)[^$]")
+    SEPARATOR_REGEX = r"(?:[^\w\d_\-.%]|$)"
+    DOMAIN_ANCHOR_REGEX = r"^(?:[^:/?#]+:)?(?://(?:[^/?#]*\.)?)?"
+
+    __slots__ = ["raw_rule_text", "is_comment", "is_html_rule", "is_exception", "options", "options_keys",
+                 "rule_text", "regex", "regex_re", "options_mask"]
+
+
+    def __init__(self, rule_text):
+        self.raw_rule_text = rule_text
+        self.regex_re = None
+        self.options_mask = None
+
+        rule_text = rule_text.strip()
+        self.is_comment = not rule_text or rule_text.startswith(("!", "[Adblock"))
+        if self.is_comment:
+            self.is_html_rule = self.is_exception = False
+        else:
+            self.is_html_rule = "##" in rule_text or "#@#" in rule_text
+            self.is_exception = rule_text.startswith("@@")
+            if self.is_exception:
+                rule_text = rule_text[2:]
+
+        if not self.is_comment and "$" in rule_text:
+            rule_text, options_text = rule_text.split("$", 1)
+            self.options = dict(FilterRule._parse_option(opt)
+                                for opt in FilterRule.OPTIONS_SPLIT_RE.split(options_text))
+        else:
+            self.options = {}
+        self.options_keys = frozenset(self.options.keys()) - {"match-case"}
+
+        self.rule_text = rule_text
+        if self.is_comment or self.is_html_rule:
+            self.regex = ""
+        else:
+            self.regex = FilterRule.rule_to_regex(rule_text)
+
+
+    @staticmethod
+    def _parse_option_negation(text):
+        return text.lstrip("~"), not text.startswith("~")
+
+
+    @staticmethod
+    def _parse_option(text):
+        if text.startswith("domain="):
+            domains = text[len("domain="):].replace(",", "|").split("|")
+            return "domain", dict(FilterRule._parse_option_negation(d) for d in domains)
+        return FilterRule._parse_option_negation(text)
+
+
+    @staticmethod
+    def rule_to_regex(rule):
+        """
+        Converts the URL part of a rule to a regular expression, the same way as adblockparser.
+        """
+        if not rule:
+            return rule
+
+        # The rule already is a regular expression
+        if rule.startswith("/") and rule.endswith("/"):
+            if len(rule) > 1:
+                return rule[1:-1]
+            raise FilterListParsingError("Invalid rule")
+
+        rule = FilterRule.REGEX_SPECIAL_CHARS_RE.sub(r"\\\1", rule)
+        rule = rule.replace("^", FilterRule.SEPARATOR_REGEX)
+        rule = rule.replace("*", ".*")
+        if rule[-1] == "|":
+            rule = rule[:-1] + "$"
+        if rule[:2] == "||":
+            if len(rule) > 2:
+                rule = FilterRule.DOMAIN_ANCHOR_REGEX + rule[2:]
+        elif rule[0] == "|":
+            rule = "^" + rule[1:]
+        return FilterRule.INNER_PIPE_RE.sub(r"\|", rule)
+
+
+    def is_supported(self):
+        """
+        :return: True if the rule can be used to match URLs at all: it is not a comment or an element hiding
+                 rule, and all of its options are supported
+        """
+        return not self.is_comment and not self.is_html_rule and bool(self.regex or self.options) and \
+            self.options_keys <= FilterRule.SUPPORTED_OPTIONS
+
+
+    def _domain_matches(self, domain):
+        domain_rules = self.options["domain"]
+        for variant in _domain_variants(domain):
+            if variant in domain_rules:
+                return domain_rules[variant]
+        return not any(domain_rules.values())
+
+
+    def accepts_options(self, options):
+        """
+        :param options: dictionary of options of the request, see FilterListEngine.should_block
+        :return: True if the options of the rule allow it to match a request with the given options. Rules that
+                 require an option that is not given never match.
+        """
+        if not self.options_keys <= options.keys():
+            return False
+
+        for option_name, option_value in self.options.items():
+            if option_name == "match-case":
+                continue
+            if option_name == "domain":
+                if not self._domain_matches(options["domain"]):
+                    return False
+            elif options[option_name] != option_value:
+                return False
+        return True
+
+
+    def match_url(self, url, options):
+        """
+        :param url: the URL to match
+        :param options: dictionary of options of the request, or an options index (see get_options_index)
+        :return: True if the rule matches the URL with the given options
+        """
+        if isinstance(options, int):
+            if self.options_mask is None:
+                # Bit i is set if the rule accepts the options of index i
+                self.options_mask = sum(1 << i for i in range(OPTIONS_INDEX_COUNT)
+                                        if self.accepts_options(options_from_index(i)))
+            if not (self.options_mask >> options) & 1:
+                return False
+        elif not self.accepts_options(options):
+            return False
+
+        if self.regex_re is None:
+            # Like adblockparser, rules without options are case-insensitive, and rules with options are not
+            self.regex_re = re.compile(self.regex, 0 if self.options else re.IGNORECASE)
+        return self.regex_re.search(url) is not None
+
+
+    def _strip_anchors(self):
+        """
+        :return: a tuple - (the rule text without its start and end anchors, whether it is anchored at the start,
+                            whether it is anchored at the end)
+        """
+        rule = self.rule_text
+        anchored_start = rule.startswith("|")
+        rule = rule[2:] if rule.startswith("||") else rule[1:] if anchored_start else rule
+        anchored_end = rule.endswith("|")
+        if anchored_end:
+            rule = rule[:-1]
+        return rule, anchored_start, anchored_end
+
+
+    def is_regex_rule(self):
+        return self.rule_text.startswith("/") and self.rule_text.endswith("/")
+
+
+    def may_have_invalid_regex(self):
+        """
+        :return: False if the regex of the rule is known to be valid. Only regex rules and rules with a '|' that
+                 is not an anchor can produce an invalid regex.
+        """
+        return bool(self.regex) and (self.is_regex_rule() or "|" in self._strip_anchors()[0])
+
+
+    def index_tokens(self):
+        """
+        :return: the (lower-case) tokens that any URL matched by this rule contains as a whole token, i.e., as a
+                 maximal run of letters, digits and '%'. The list is empty if the rule cannot be indexed.
+        """
+        if not self.rule_text or self.is_regex_rule():
+            return []
+
+        rule, anchored_start, anchored_end = self._strip_anchors()
+        # Any other '|' changes the meaning of the rule in ways that tokens can not capture
+        if "|" in rule:
+            return []
+
+        tokens = []
+        for match in FilterListEngine.TOKEN_RE.finditer(rule.lower()):
+            start, end = match.span()
+            if start == 0:
+                bounded = anchored_start
+            else:
+                bounded = _is_token_boundary(rule[start - 1])
+            if end == len(rule):
+                bounded = bounded and anchored_end
+            else:
+                bounded = bounded and _is_token_boundary(rule[end])
+            if bounded:
+                tokens.append(match.group())
+        return tokens
+
+
+def _is_token_boundary(char):
+    # '*' may stand for token characters; non-ASCII characters may match ASCII ones when ignoring case
+    return char != "*" and char.isascii() and FilterListEngine.TOKEN_RE.match(char.lower()) is None
+
+
+def _domain_variants(domain):
+    parts = domain.split(".")
+    if len(parts) == 1:
+        yield parts[0]
+    else:
+        for i in range(len(parts), 1, -1):
+            yield ".".join(parts[-i:])
+
+
+class FilterListEngine(object):
+    """
+    Matches URLs against the rules of one filter list. Drop-in replacement for adblockparser.AdblockRules.
+    """
+
+    TOKEN_RE = re.compile(r"[a-z0-9%]+")
+
+    def __init__(self, lines):
+        """
+        :param lines: the lines of the filter list
+        """
+        rules = []
+        for rule in (FilterRule(line) for line in lines):
+            if not rule.is_supported():
+                continue
+            # Regexes are otherwise only compiled when a rule is first checked
+            if rule.may_have_invalid_regex():
+                try:
+                    re.compile(rule.regex)
+                except re.error as e:
+                    # Like adblockparser, refuse the whole list if a rule without options is not a valid regex.
+                    # adblockparser only compiles rules with options when they are checked, and then fails on
+                    # every URL that reaches them; such a rule can never match, so only that rule is skipped.
+                    if not rule.options:
+                        raise FilterListParsingError("Invalid rule %r: %s" % (rule.raw_rule_text.strip(), e))
+                    print("WARNING: skipping rule %r: %s" % (rule.raw_rule_text.strip(), e))
+                    continue
+            rules.append(rule)
+
+        # Index each rule by its least common token, so that the buckets stay small
+        rule_tokens = [rule.index_tokens() for rule in rules]
+        token_counts = {}
+        for tokens in rule_tokens:
+            for token in tokens:
+                token_counts[token] = token_counts.get(token, 0) + 1
+
+        self.whitelist = ({}, [])
+        self.blacklist = ({}, [])
+        for rule, tokens in zip(rules, rule_tokens):
+            index, unindexed = self.whitelist if rule.is_exception else self.blacklist
+            if tokens:
+                token = min(tokens, key=lambda t: (token_counts[t], -len(t)))
+                index.setdefault(token, []).append(rule)
+            else:
+                unindexed.append(rule)
+        self.rule_count = len(rules)
+
+
+    @staticmethod
+    def _matches(rules, url, url_tokens, options):
+        index, unindexed = rules
+        for rule in unindexed:
+            if rule.match_url(url, options):
+                return True
+        if url_tokens is None:
+            # The tokens of the URL are not reliable, check all rules
+            buckets = index.values()
+        else:
+            buckets = [index[token] for token in url_tokens if token in index]
+        for bucket in buckets:
+            for rule in bucket:
+                if rule.match_url(url, options):
+                    return True
+        return False
+
+
+    def should_block(self, url, options=None):
+        """
+        :param url: the URL of the request
+        :param options: dictionary of options of the request, e.g., {"script": True, "third-party": False}, or
+                        an options index (see get_options_index), which is faster
+        :return: True if the URL is matched by a blocking rule and not by an exception rule
+        """
+        if options is None:
+            options = {}
+        # Non-ASCII characters may match ASCII ones when ignoring case, so such URLs are checked against all rules
+        url_tokens = set(FilterListEngine.TOKEN_RE.findall(url.lower())) if url.isascii() else None
+        if FilterListEngine._matches(self.whitelist, url, url_tokens, options):
+            return False
+        return FilterListEngine._matches(self.blacklist, url, url_tokens, options)
+
+
+def init_rule_checker(filter_list_file, engine="token"):
+    """
+    Initializes a matcher for a filter list stored in a given file.
+    :param filter_list_file: The path to the filter list file.
+    :param engine: "token" for a FilterListEngine, or "adblockparser" for an adblockparser.AdblockRules instance
+    :return: a matcher with a should_block(url, options) method
+    """
+    print("Reading in filter list: %s" % filter_list_file)
+    with open(filter_list_file, "r") as f:
+        lines = f.readlines()
+    if engine == "adblockparser":
+        from adblockparser import AdblockRules
+        return AdblockRules(lines)
+    return FilterListEngine(lines)
+
+
+# A loaded filter list: its name, its matcher, and the SHA-256 digest of the contents of its file
+FilterList = namedtuple("FilterList", ["name", "rules", "digest"])
+
+# Filter lists that were already loaded by this process: (directory, engine) -> list of FilterList
+_loaded_filter_lists = {}
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_filter_lists(filter_list_dir, engine="token"):
+    """
+    Loads all filter lists in a directory. Each directory is only loaded once per process.
+    :param filter_list_dir: Path to a directory containing filter lists in EasyList (ABP) format.
+    :param engine: see init_rule_checker
+    :return: a list of FilterList tuples, the name being the file name without its extension
+    """
+    cache_key = (os.path.abspath(filter_list_dir), engine)
+    if cache_key in _loaded_filter_lists:
+        return _loaded_filter_lists[cache_key]
+
+    fl_matchers = []
+    for fl_file in sorted(os.listdir(filter_list_dir)):
+        if "DS_Store" in fl_file:
+            continue
+        fl_path = os.path.join(filter_list_dir, fl_file)
+        ext_start = fl_file.rfind(".")
+        if ext_start < 0:
+            print("WARNING: skipping filter list file '" + fl_file +
+                  "' as the filename does not contain a file extension.")
+            continue
+        # Name of filter list becomes filename minus file extension
+        fl_name = fl_file[0:ext_start]
+        try:
+            fl_matchers.append(FilterList(fl_name, init_rule_checker(fl_path, engine=engine), file_digest(fl_path)))
+        except Exception as e:
+            print("Could not parse rule file: %s" % fl_path)
+            print(e)
+
+    _loaded_filter_lists[cache_key] = fl_matchers
+    return fl_matchers
@@ -14,6 +14,7 @@
 
 package_name = "package_name"
 version = "package_version"
+device = "device"
 type = "type"
 ats_pkg = "ats_pkg"
 id = "pkt_id"
@@ -55,6 +56,13 @@ frame = "frame"
 frame_num = frame + ".number"
 frame_comment = frame + ".comment"
 frame_ts = frame + ".time_epoch"
+ts = "ts"
+
+# Flow records, see aggregate_flows.py
+flow_id = "flow_id"
+packet_count = "packet_count"
+first_ts = "first_ts"
+last_ts = "last_ts"
 
 # Non HTTP packets
 irc = "irc"
@@ -62,7 +70,7 @@ websocket = "websocket"
 websocketdata = "data-text-lines"
 
 # From Lab for VR
-LOCATION_PII = [{"33.6459","-117.843"}, {"33.65","-117.84"},  {"33.6","-117.8"}, {"33.7","-117.8"}]
+LOCATION_PII = [("33.6459", "-117.843"), ("33.65", "-117.84"), ("33.6", "-117.8"), ("33.7", "-117.8")]
 
 ANTMONITOR_SRC_IP = "192.168.0.2"
 
@@ -280,6 +288,18 @@ OTHER__PII_VALUES__WEBSOCKET = {
 }
 
 
+# PII values of each device, by the device name found in the packet comments
+DEVICE_PII_VALUES = {
+    "QUEST2A": QUEST2A__PII_VALUES,
+    "QUEST2B": QUEST2B__PII_VALUES,
+}
+
+# PII values that are searched for regardless of the device
+COMMON_PII_VALUES = dict()
+COMMON_PII_VALUES.update(OTHER__PII_VALUES)
+COMMON_PII_VALUES.update(OTHER__PII_VALUES__BY_KEY)
+COMMON_PII_VALUES.update(OTHER__PII_VALUES__WEBSOCKET)
+
 # merge the above dict into one. Make sure the keys are unique
 PII_VALUES = dict()
 PII_VALUES.update(QUEST2A__PII_VALUES)
@@ -3,7 +3,7 @@
 """
 Use this script to merge encrypted/decrypted PCAP files into one
 USAGE:
-$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY
+$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY [--merge-only]
 """
 
 import os, sys
@@ -11,8 +11,40 @@ import os, sys
 from subprocess import call
 from subprocess import check_call
 
+# Preferences used whenever tshark dissects our merged traces
+TSHARK_PREFS = ["-o", "tcp.analyze_sequence_numbers:TRUE",
+                "-o", "tcp.desegment_tcp_streams:TRUE",
+                "-o", "http.desegment_body:TRUE"]
+
+
+def get_tshark_cmd(pcap_file, output_args=("-T", "json")):
+    """
+    Build the tshark command line used to dissect a merged trace.
+    :param pcap_file: the merged PCAPNG file to dissect
+    :param output_args: tshark arguments that select the output format and content
+    :return: the command as a list of arguments
+    """
+    return ["tshark"] + TSHARK_PREFS + ["-r", pcap_file] + list(output_args)
+
+
+def get_files_to_merge(encdec, dir_path):
+    """
+    List the PCAP files of an app that make up its encrypted or decrypted trace.
+    :param encdec: '-enc' or '-dec'
+    :param dir_path: the directory that contains the PCAP files of the app
+    :return: a list of file names in dir_path
+    """
+    files_to_merge = []
+    for fn in os.listdir(dir_path):
+        if encdec == '-enc' and fn.startswith("COMPLETED") and \
+            fn.find("DECRYPTED") == -1:
+            files_to_merge.append(fn)
+        elif encdec == '-dec' and fn.startswith("COMPLETED_DECRYPTED"):
+            files_to_merge.append(fn)
+    return files_to_merge
+
 
-def merge_in_dir(encdec, dir_path):
+def merge_in_dir(encdec, dir_path, merge_only=False):
     dir_path = os.path.abspath(dir_path)
 
     if not os.path.isdir(dir_path):
@@ -24,13 +56,7 @@ def merge_in_dir(encdec, dir_path):
     except (WindowsError, OSError):
         print("Could not change directory to " + dir_path)
 
-    files_to_merge = []
-    for fn in os.listdir(dir_path):
-        if encdec == '-enc' and fn.startswith("COMPLETED") and \
-            fn.find("DECRYPTED") == -1:
-            files_to_merge.append(fn)
-        elif encdec == '-dec' and fn.startswith("COMPLETED_DECRYPTED"):
-            files_to_merge.append(fn)
+    files_to_merge = get_files_to_merge(encdec, dir_path)
 
     baseDir = os.path.basename(os.path.realpath(dir_path))
     if encdec == '-enc':
@@ -43,16 +69,15 @@ def merge_in_dir(encdec, dir_path):
     call(cmd)
     print("Merged " + str(len(files_to_merge)) + " files into " + outFile)
 
+    if merge_only:
+        return
+
     if encdec == '-enc':
         jsonFile = baseDir + "-ENC-out.json"
     else:
         jsonFile = baseDir + "-DEC-out.json"
 
-    cmd = ["tshark",
-           "-o", "tcp.analyze_sequence_numbers:TRUE",
-           "-o", "tcp.desegment_tcp_streams:TRUE",
-           "-o", "http.desegment_body:TRUE",
-           "-r", outFile, "-T", "json"]
+    cmd = get_tshark_cmd(outFile)
 
     with open(jsonFile, "wb") as jf:
         check_call(cmd, stdout=jf)
@@ -61,9 +86,10 @@ def merge_in_dir(encdec, dir_path):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3 or not (sys.argv[1] == '-dec' or sys.argv[1] == '-enc'):
+    if len(sys.argv) not in (3, 4) or not (sys.argv[1] == '-dec' or sys.argv[1] == '-enc') or \
+            (len(sys.argv) == 4 and sys.argv[3] != '--merge-only'):
         print("ERROR: incorrect number of arguments or wrong arguments. Correct usage:")
-        print("\t$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY")
+        print("\t$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY [--merge-only]")
         sys.exit(1)
 
-    merge_in_dir(sys.argv[1], sys.argv[2])
+    merge_in_dir(sys.argv[1], sys.argv[2], merge_only=len(sys.argv) == 4)
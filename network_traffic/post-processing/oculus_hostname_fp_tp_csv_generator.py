@@ -1,6 +1,7 @@
 import unicodecsv as csv
 import argparse
-import tldextract
+import public_suffix
+from functools import lru_cache
 
 
 class DeviceAppInfo:
@@ -52,6 +53,13 @@ def _get_second_level_domain_from_tld(url_tld):
     return url_tld.domain + "." + url_tld.suffix
 
 
+@lru_cache(maxsize=None)
+def _get_package_name_tokens(package_name):
+    # tokenize package_name
+    package_name_tokens = package_name.split(".")
+    return tuple(x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2)
+
+
 def _is_first_party(sld, package_name, current_app, host_name):
     # force first party?
     if FORCE_FIRST_PARTY.get(package_name) and (host_name in FORCE_FIRST_PARTY.get(package_name) or sld in FORCE_FIRST_PARTY.get(package_name)):
@@ -59,11 +67,9 @@ def _is_first_party(sld, package_name, current_app, host_name):
               ( package_name, host_name))
         return True
 
-    # tokenize package_name
-    package_name_tokens = package_name.split(".")
-    package_name_tokens = [x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2]
+    package_name_tokens = list(_get_package_name_tokens(package_name))
 
-    dest_domain_parsed = tldextract.extract(host_name)
+    dest_domain_parsed = public_suffix.extract(host_name)
 
     # extract the eSLD for comparison
     # if it's hosted on a cloud service, take the subdomain instead
@@ -75,7 +81,7 @@ def _is_first_party(sld, package_name, current_app, host_name):
 
     # check privacy policy url first
     if current_app.policy_url and current_app.policy_url != "N/A":
-        policy_domain_parsed = tldextract.extract(current_app.policy_url)
+        policy_domain_parsed = public_suffix.extract(current_app.policy_url)
         if policy_domain_parsed.registered_domain == domain_cmp:
             print("First party due to privacy url %s, package name %s, hostname %s" %
                   (current_app.policy_url, package_name, host_name))
@@ -102,45 +108,71 @@ def get_ais_key(app_id, package_name):
     return app_id+package_name
 
 
-def get_party_labels(sld, current_app, hostname):
-    party_labels = []
-
-    package = current_app.app_package
-    if not package or len(package) == 0:
-        package = current_app.package_name
-
-    # is hostname contacted by multiple apps?
-    apps_contacted = hostname_to_apps[sld]
-    if apps_contacted and len(apps_contacted) > 1:
-        # good chance it could be third party
-        same_developer = True
-        for other_app in apps_contacted:
-            if other_app.developer_name != current_app.developer_name:
-                same_developer = False
-                break
+class PartyLabeler:
+    """
+    Labels the (app, hostname) pairs of the packets/flows. Labels only depend on the app, the hostname and its SLD,
+    so each unique (app key, sld, hostname) is labelled once and the labels are reused for all its rows.
+    """
 
-        if not same_developer:
-            if _is_first_party(sld, package, current_app, hostname):
-                party_labels.append(FIRST_PARTY)
-            else:
-                party_labels.append(THIRD_PARTY)
-                if _is_platform(current_app, hostname, consider_domain_only=True):
-                    party_labels.append(PLATFORM)
+    def __init__(self, hostname_to_apps):
+        """
+        :param hostname_to_apps: dict of sld -> list of DeviceAppInfo of the apps that contacted it
+        """
+        self.hostname_to_apps = hostname_to_apps
+        # Developers of the apps that contacted each sld
+        self.sld_to_developers = {sld: {app.developer_name for app in apps} for sld, apps in hostname_to_apps.items()}
+        # (app key, sld, hostname) -> party labels
+        self.party_labels = {}
+
+    def get_party_labels(self, key, sld, current_app, hostname):
+        """
+        :param key: key of current_app, see get_ais_key
+        :return: the list of party labels of the hostname for the app, computed once per (key, sld, hostname)
+        """
+        memo_key = (key, sld, hostname)
+        party_labels = self.party_labels.get(memo_key)
+        if party_labels is None:
+            print("*******Getting party label for App %s, Developer %s, sld: %s, hostname: %s" % (current_app.app_name, current_app.developer_name, sld, hostname))
+            party_labels = self._get_party_labels(sld, current_app, hostname)
+            print("Party labels %s found for SLD %s" % (",".join(party_labels), sld))
+            self.party_labels[memo_key] = party_labels
+        return party_labels
+
+    def _get_party_labels(self, sld, current_app, hostname):
+        party_labels = []
+
+        package = current_app.app_package
+        if not package or len(package) == 0:
+            package = current_app.package_name
+
+        # is hostname contacted by multiple apps?
+        apps_contacted = self.hostname_to_apps[sld]
+        if apps_contacted and len(apps_contacted) > 1:
+            # good chance it could be third party
+            same_developer = self.sld_to_developers[sld] == {current_app.developer_name}
+
+            if not same_developer:
+                if _is_first_party(sld, package, current_app, hostname):
+                    party_labels.append(FIRST_PARTY)
+                else:
+                    party_labels.append(THIRD_PARTY)
+                    if _is_platform(current_app, hostname, consider_domain_only=True):
+                        party_labels.append(PLATFORM)
 
-            return party_labels
+                return party_labels
 
-    # if we reach here, we know it is either first_party, unknown, potential platform
+        # if we reach here, we know it is either first_party, unknown, potential platform
 
-    if _is_first_party(sld, package, current_app, hostname):
-        party_labels.append(FIRST_PARTY)
-    else:
-        if _is_platform(current_app, hostname, consider_domain_only=True):
-            party_labels.append(PLATFORM)
+        if _is_first_party(sld, package, current_app, hostname):
+            party_labels.append(FIRST_PARTY)
+        else:
+            if _is_platform(current_app, hostname, consider_domain_only=True):
+                party_labels.append(PLATFORM)
 
-    if len(party_labels) == 0:
-        party_labels.append(UNKNOWN_PARTY)
+        if len(party_labels) == 0:
+            party_labels.append(UNKNOWN_PARTY)
 
-    return party_labels
+        return party_labels
 
 # =================== CSV column names ===================
 csv_key_app_id = "app_id"
@@ -250,6 +282,8 @@ if __name__ == '__main__':
 
     print("Found %d App Infos for Device" % len(ais))
 
+    party_labeler = PartyLabeler(hostname_to_apps)
+
     # read in the file again to do the second time to label each row, and write it out as well
     with open(args.in_csv, "rb") as in_csv_file:
         csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
@@ -265,24 +299,16 @@ if __name__ == '__main__':
                 hostname = row[csv_key_hostname]
                 app_name = row[csv_key_app_name_from_web_store]
                 package_name = row[csv_key_package_name]
-                if row[csv_key_app_developer_oculus]:
-                    developer_name = row[csv_key_app_developer_oculus]
-                else:
-                    developer_name = row[csv_key_app_developer_sidequest]
-                # Get existing AppInfo, if any, otherwise create new.
+                # Get existing AppInfo
                 key = get_ais_key(app_id, package_name)
                 ai = ais.get(key)
                 if not ai:
-                    print("ERROR: could not find App info for %s, %s" + (app_id, app_name))
+                    print("ERROR: could not find App info for %s, %s" % (app_id, app_name))
                     print("Skipping row " + hostname)
                     continue
 
                 sld = hostname_to_sld[hostname]
-                print("*******Getting party label for App %s, Developer %s, sld: %s, hostname: %s" % (ai.app_name, developer_name, sld, hostname))
-
-                party_labels = get_party_labels(sld, ai, hostname)
-                print("Party labels %s found for SLD %s" % (",".join(party_labels), sld))
-                print("*******Done party label for App %s, Developer %s, sld: %s, hostname: %s" % (ai.app_name, developer_name, sld, hostname))
+                party_labels = party_labeler.get_party_labels(key, sld, ai, hostname)
 
                 # put into array by header order (ignoring the last column, since that is party_labels)
                 data_row = [row[header_name] for header_name in csv_header[0:-2]]
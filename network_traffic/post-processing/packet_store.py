@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Columnar store for packets in NoMoAds format: a Parquet file with one row per packet and a fixed set of columns for
+the fields in json_keys. Stages after the extraction add their own columns (e.g., one block decision column per
+filter list), and later stages only read the columns they need.
+
+Also reads and writes NoMoAds json files, which hold an array of packets, each with its pkt_id. Files written before
+packet ids were integers hold an object of uuid -> packet instead, and can still be read.
+
+pyarrow is only needed when a Parquet store is actually used.
+"""
+
+import json
+import json_keys
+
+PARQUET_EXTENSION = ".parquet"
+
+# Number of packets per Parquet row group when writing
+BATCH_SIZE = 10000
+
+# (column, type) of the fixed columns; type is one of "string", "int64", "string_list", "json"
+# "json" columns hold dictionaries, stored as JSON strings
+PACKET_COLUMNS = [
+    (json_keys.id, "int64"),
+    (json_keys.protocol, "string"),
+    (json_keys.src_ip, "string"),
+    (json_keys.dst_ip, "string"),
+    (json_keys.dst_port, "int64"),
+    (json_keys.tcpstream, "int64"),
+    (json_keys.host, "string"),
+    (json_keys.method, "string"),
+    (json_keys.uri, "string"),
+    (json_keys.headers, "json"),
+    (json_keys.pii_label, "string_list"),
+    (json_keys.package_name, "string"),
+    (json_keys.version, "string"),
+    (json_keys.ts, "string"),
+    (json_keys.http_body, "string"),
+]
+PACKET_COLUMN_TYPES = dict(PACKET_COLUMNS)
+
+
+def is_packet_store(path):
+    return path.endswith(PARQUET_EXTENSION)
+
+
+def get_packet_id(frame_number, is_decrypted):
+    """
+    Packet ids are derived from the capture, so that extracting the same traces twice gives the same ids. The
+    decrypted and the encrypted trace of an app are numbered separately, so the lowest bit tells them apart.
+    :param frame_number: the frame number of the packet in its trace
+    :param is_decrypted: whether the packet comes from the decrypted trace
+    :return: an integer that is unique among the packets of an app
+    """
+    return (int(frame_number) << 1) | int(bool(is_decrypted))
+
+
+def read_json_packets(path):
+    """
+    Reads a NoMoAds json file into the same in-memory representation as read_packets.
+    :param path: path of a NoMoAds json file, with either an array of packets or an object of key -> packet
+    :return: a dictionary of key -> packet, in the order of the file, without the pkt_id fields
+    """
+    with open(path, "r") as jf:
+        data = json.load(jf)
+    if isinstance(data, dict):
+        return data
+    return {packet.pop(json_keys.id): packet for packet in data}
+
+
+def write_json_packets(packets, path):
+    """
+    Writes packets to a NoMoAds json file as they are produced, without holding all packets in memory.
+    :param packets: an iterable of (key, packet) tuples; the key is stored in the pkt_id field of each packet
+    :param path: path of the json file
+    :return: the number of packets written
+    """
+    count = 0
+    with open(path, "w") as jf:
+        jf.write("[")
+        for key, packet in packets:
+            record = dict(packet)
+            record[json_keys.id] = key
+            jf.write(("\n" if count == 0 else ",\n") + "    " +
+                     json.dumps(record, sort_keys=True, indent=4).replace("\n", "\n    "))
+            count += 1
+        jf.write("\n]" if count else "]")
+    return count
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is needed to read and write Parquet packet stores: pip3 install pyarrow")
+    return pyarrow
+
+
+def get_schema():
+    pa = _import_pyarrow()
+    arrow_types = {"string": pa.string(), "int64": pa.int64(), "string_list": pa.list_(pa.string()),
+                   "json": pa.string()}
+    return pa.schema([(column, arrow_types[column_type]) for column, column_type in PACKET_COLUMNS])
+
+
+def _to_column_value(value, column_type):
+    if value is None:
+        return None
+    if column_type == "json":
+        return json.dumps(value)
+    if column_type == "int64":
+        return int(value)
+    return value
+
+
+def write_packets(packets, path):
+    """
+    Writes packets in NoMoAds format to a new Parquet packet store, a batch at a time.
+    :param packets: an iterable of (key, packet) tuples; the key is stored in the pkt_id column
+    :param path: path of the Parquet file
+    :return: the number of packets written
+    """
+    pa = _import_pyarrow()
+    schema = get_schema()
+    count = 0
+    with pa.parquet.ParquetWriter(path, schema) as writer:
+        batch = {column: [] for column, _ in PACKET_COLUMNS}
+
+        def flush():
+            writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+            for values in batch.values():
+                del values[:]
+
+        for key, packet in packets:
+            for column, column_type in PACKET_COLUMNS:
+                value = key if column == json_keys.id else packet.get(column)
+                batch[column].append(_to_column_value(value, column_type))
+            count += 1
+            if count % BATCH_SIZE == 0:
+                flush()
+        if count == 0 or count % BATCH_SIZE != 0:
+            flush()
+    return count
+
+
+def read_table(path, columns=None):
+    """
+    :param path: path of the Parquet packet store
+    :param columns: names of the columns to read, or None for all columns
+    :return: a pyarrow Table
+    """
+    pa = _import_pyarrow()
+    return pa.parquet.read_table(path, columns=columns)
+
+
+def read_packets(path, columns=None):
+    """
+    Reads a Parquet packet store into the same in-memory representation as a NoMoAds json file.
+    :param path: path of the Parquet packet store
+    :param columns: names of the columns to read besides pkt_id, or None for all columns
+    :return: a dictionary of key -> packet, in the order of the store. Fields that are null are left out of the
+             packets, like fields that are absent from the json.
+    """
+    if columns is not None:
+        columns = [json_keys.id] + [column for column in columns if column != json_keys.id]
+    table = read_table(path, columns=columns)
+    data = table.to_pydict()
+    column_names = [column for column in table.column_names if column != json_keys.id]
+    packets = {}
+    for i, key in enumerate(data[json_keys.id]):
+        packet = {}
+        for column in column_names:
+            value = data[column][i]
+            if value is None:
+                continue
+            if PACKET_COLUMN_TYPES.get(column) == "json":
+                value = json.loads(value)
+            packet[column] = value
+        packets[key] = packet
+    return packets
+
+
+def add_columns(path, out_path, new_columns, column_type="int64"):
+    """
+    Writes a copy of a Parquet packet store with more columns, e.g., the results of a stage. Columns that already
+    exist are replaced.
+    :param path: path of the Parquet packet store
+    :param out_path: path of the new Parquet packet store, which can be the same as path
+    :param new_columns: a list of (column name, values) tuples, with one value per row of the store
+    :param column_type: the pyarrow type name of the new columns
+    """
+    pa = _import_pyarrow()
+    table = read_table(path)
+    for column, values in new_columns:
+        array = pa.array(values, type=pa.type_for_alias(column_type))
+        if column in table.column_names:
+            table = table.set_column(table.column_names.index(column), column, array)
+        else:
+            table = table.append_column(column, array)
+    pa.parquet.write_table(table, out_path)
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Lightweight reader for merged PCAPNG traces that gets the TLS ClientHello packets and their server name (SNI) without
+running tshark. The file is memory-mapped and only the blocks, headers, and records needed for the extraction of
+encrypted traces are parsed: Enhanced Packet Blocks and their comment, IPv4/IPv6 and TCP headers, and the TLS
+handshake records at the start of the outgoing TCP streams.
+
+TCP streams are numbered like tshark numbers its tcp.stream field: in the order in which their first packet appears in
+the trace, with a new stream when a SYN reuses the ports of an earlier connection with another sequence number.
+
+tests/test_pcapng_reader.py checks the extracted fields against the values that tshark gives; --compare does the same
+for a real capture, with tshark.
+"""
+
+import argparse
+import collections
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+
+# =================== PCAPNG blocks and options ===================
+BLOCK_SECTION_HEADER = 0x0A0D0D0A
+BLOCK_INTERFACE_DESCRIPTION = 0x00000001
+BLOCK_OBSOLETE_PACKET = 0x00000002
+BLOCK_SIMPLE_PACKET = 0x00000003
+BLOCK_ENHANCED_PACKET = 0x00000006
+PACKET_BLOCKS = {BLOCK_OBSOLETE_PACKET, BLOCK_SIMPLE_PACKET, BLOCK_ENHANCED_PACKET}
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+OPT_IF_TSRESOL = 9
+OPT_IF_TSOFFSET = 14
+
+# Timestamps are in microseconds unless the interface says otherwise
+DEFAULT_TICKS_PER_SECOND = 10 ** 6
+# =================================================================
+
+# =================== Link, network, and transport layers ===================
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = {0x8100, 0x88A8}
+
+IP_PROTO_TCP = 6
+# IPv6 extension headers that can come before the TCP header (fragmented packets are skipped)
+IPV6_EXTENSION_HEADERS = {0, 43, 60}
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+# ===========================================================================
+
+# =================== TLS ===================
+TLS_CONTENT_HANDSHAKE = 22
+TLS_HANDSHAKE_CLIENT_HELLO = 1
+TLS_EXTENSION_SERVER_NAME = 0
+TLS_SERVER_NAME_HOST_NAME = 0
+TLS_RECORD_HEADER_LENGTH = 5
+# ClientHellos are much smaller than this; larger "records" are not TLS
+MAX_CLIENT_HELLO_LENGTH = 1 << 16
+# ===========================================
+
+Interface = collections.namedtuple("Interface", "link_type ticks_per_second ts_offset")
+
+# A packet of a PCAPNG file: frame_number counts the packet blocks from 1, as tshark does; ts is formatted like the
+# frame.time_epoch field of tshark; comment is the first comment of the packet, or None
+Packet = collections.namedtuple("Packet", "frame_number link_type ts data comment")
+
+# A TLS ClientHello with a server name, sent from src_ip:src_port to dst_ip:dst_port. For a ClientHello that spans
+# several segments, the frame is the one of its last segment.
+ClientHello = collections.namedtuple("ClientHello",
+                                     "frame_number ts comment src_ip dst_ip src_port dst_port tcp_stream server_name")
+
+
+def _pad4(length):
+    return (length + 3) & ~3
+
+
+def _iter_options(buf, pos, end, endian):
+    """
+    :return: a generator of (option code, option value) tuples of the options in buf[pos:end]
+    """
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, pos)
+        if code == OPT_ENDOFOPT:
+            return
+        yield code, buf[pos + 4:pos + 4 + length]
+        pos += 4 + _pad4(length)
+
+
+def _read_interface(buf, pos, block_length, endian):
+    link_type = struct.unpack_from(endian + "H", buf, pos + 8)[0]
+    ticks_per_second = DEFAULT_TICKS_PER_SECOND
+    ts_offset = 0
+    for code, value in _iter_options(buf, pos + 16, pos + block_length - 4, endian):
+        if code == OPT_IF_TSRESOL and len(value) == 1:
+            # The most significant bit tells whether the resolution is a power of 2 or of 10
+            if value[0] & 0x80:
+                ticks_per_second = 2 ** (value[0] & 0x7F)
+            else:
+                ticks_per_second = 10 ** value[0]
+        elif code == OPT_IF_TSOFFSET and len(value) == 8:
+            ts_offset = struct.unpack(endian + "q", value)[0]
+    return Interface(link_type, ticks_per_second, ts_offset)
+
+
+def format_ts(ticks, interface):
+    """
+    :return: the timestamp in seconds since the epoch with 9 decimals, e.g., "1620000000.000054000"
+    """
+    seconds, remainder = divmod(ticks, interface.ticks_per_second)
+    nanoseconds = remainder * 10 ** 9 // interface.ticks_per_second
+    return "%d.%09d" % (seconds + interface.ts_offset, nanoseconds)
+
+
+def iter_packets(pcap_file):
+    """
+    Reads the packets of a PCAPNG file through a memory map.
+    :param pcap_file: path of the PCAPNG file
+    :return: a generator of Packet tuples, in the order of the file. Packets of Simple Packet Blocks, which have no
+             timestamp, are counted in the frame numbers but not returned.
+    """
+    with open(pcap_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            size = len(buf)
+            endian = "<"
+            interfaces = []
+            frame_number = 0
+            pos = 0
+            while pos + 12 <= size:
+                block_type, block_length = struct.unpack_from(endian + "II", buf, pos)
+                if block_type == BLOCK_SECTION_HEADER:
+                    # Each section can have its own byte order and interfaces
+                    endian = "<" if struct.unpack_from("<I", buf, pos + 8)[0] == BYTE_ORDER_MAGIC else ">"
+                    block_length = struct.unpack_from(endian + "I", buf, pos + 4)[0]
+                    interfaces = []
+                if block_length < 12 or pos + block_length > size:
+                    print("WARNING: truncated PCAPNG block at offset %d in %s" % (pos, pcap_file))
+                    return
+
+                if block_type == BLOCK_INTERFACE_DESCRIPTION:
+                    interfaces.append(_read_interface(buf, pos, block_length, endian))
+                elif block_type in PACKET_BLOCKS:
+                    frame_number += 1
+                    if block_type != BLOCK_SIMPLE_PACKET:
+                        if block_type == BLOCK_ENHANCED_PACKET:
+                            interface_id, ts_high, ts_low, captured_length = \
+                                struct.unpack_from(endian + "IIII", buf, pos + 8)
+                        else:
+                            interface_id, _, ts_high, ts_low, captured_length = \
+                                struct.unpack_from(endian + "HHIII", buf, pos + 8)
+                        interface = interfaces[interface_id]
+                        data_start = pos + 28
+                        comment = None
+                        for code, value in _iter_options(buf, data_start + _pad4(captured_length),
+                                                         pos + block_length - 4, endian):
+                            if code == OPT_COMMENT:
+                                comment = value.decode("utf-8", errors="replace")
+                                break
+                        yield Packet(frame_number, interface.link_type,
+                                     format_ts((ts_high << 32) | ts_low, interface),
+                                     buf[data_start:data_start + captured_length], comment)
+                pos += block_length
+
+
+def get_ip_offset(link_type, data):
+    """
+    :return: the offset of the IP header in the data of a packet, or None if the packet is not IP
+    """
+    if link_type in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return 0
+    if link_type in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        return 4
+    if link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ether_type = struct.unpack_from("!H", data, offset)[0] if len(data) >= offset + 2 else None
+        while ether_type in ETHERTYPE_VLAN and len(data) >= offset + 6:
+            offset += 4
+            ether_type = struct.unpack_from("!H", data, offset)[0]
+        return offset + 2 if ether_type in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if link_type == LINKTYPE_LINUX_SLL:
+        return 16
+    if link_type == LINKTYPE_LINUX_SLL2:
+        return 20
+    return None
+
+
+def parse_tcp_segment(link_type, data):
+    """
+    :return: a (IP version, src IP, dst IP, src port, dst port, seq, flags, payload) tuple, or None if the packet is
+             not a TCP segment. Fragmented IP packets are skipped.
+    """
+    offset = get_ip_offset(link_type, data)
+    if offset is None or len(data) < offset + 20:
+        return None
+    version = data[offset] >> 4
+    if version == 4:
+        header_length = (data[offset] & 0x0F) * 4
+        total_length, fragment = struct.unpack_from("!H2xH", data, offset + 2)
+        # More fragments flag or fragment offset
+        if fragment & 0x3FFF or data[offset + 9] != IP_PROTO_TCP:
+            return None
+        src_ip = socket.inet_ntop(socket.AF_INET, data[offset + 12:offset + 16])
+        dst_ip = socket.inet_ntop(socket.AF_INET, data[offset + 16:offset + 20])
+        # The IP total length leaves out link layer padding
+        end = min(len(data), offset + total_length)
+        tcp_offset = offset + header_length
+    elif version == 6:
+        if len(data) < offset + 40:
+            return None
+        payload_length = struct.unpack_from("!H", data, offset + 4)[0]
+        next_header = data[offset + 6]
+        src_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 8:offset + 24])
+        dst_ip = socket.inet_ntop(socket.AF_INET6, data[offset + 24:offset + 40])
+        end = min(len(data), offset + 40 + payload_length)
+        tcp_offset = offset + 40
+        while next_header in IPV6_EXTENSION_HEADERS and tcp_offset + 2 <= end:
+            next_header, length = data[tcp_offset], data[tcp_offset + 1]
+            tcp_offset += (length + 1) * 8
+        if next_header != IP_PROTO_TCP:
+            return None
+    else:
+        return None
+
+    if tcp_offset + 20 > end:
+        return None
+    src_port, dst_port, seq, _, data_offset, flags = struct.unpack_from("!HHIIBB", data, tcp_offset)
+    payload_offset = tcp_offset + (data_offset >> 4) * 4
+    return version, src_ip, dst_ip, src_port, dst_port, seq, flags, data[payload_offset:end]
+
+
+def get_server_name(record):
+    """
+    :param record: a complete TLS record
+    :return: the host name of the server name extension if the record is a ClientHello, otherwise None
+    """
+    if len(record) < TLS_RECORD_HEADER_LENGTH + 4 or record[0] != TLS_CONTENT_HANDSHAKE or \
+            record[TLS_RECORD_HEADER_LENGTH] != TLS_HANDSHAKE_CLIENT_HELLO:
+        return None
+    try:
+        # Skip the record and handshake headers, the client version, and the random
+        pos = TLS_RECORD_HEADER_LENGTH + 4 + 2 + 32
+        # session id, cipher suites, compression methods
+        pos += 1 + record[pos]
+        pos += 2 + struct.unpack_from("!H", record, pos)[0]
+        pos += 1 + record[pos]
+        extensions_end = pos + 2 + struct.unpack_from("!H", record, pos)[0]
+        pos += 2
+        while pos + 4 <= extensions_end:
+            extension_type, extension_length = struct.unpack_from("!HH", record, pos)
+            pos += 4
+            if extension_type == TLS_EXTENSION_SERVER_NAME:
+                names_end = pos + 2 + struct.unpack_from("!H", record, pos)[0]
+                pos += 2
+                while pos + 3 <= names_end:
+                    name_type, name_length = struct.unpack_from("!BH", record, pos)
+                    pos += 3
+                    if name_type == TLS_SERVER_NAME_HOST_NAME:
+                        if pos + name_length > min(names_end, len(record)):
+                            # tshark reports the extension as malformed
+                            return None
+                        return bytes(record[pos:pos + name_length]).decode("utf-8", errors="replace")
+                    pos += name_length
+                return None
+            pos += extension_length
+    except (IndexError, struct.error):
+        # Truncated or not really TLS
+        pass
+    return None
+
+
+class _Connection(object):
+    __slots__ = ["tcp_stream", "base_seqs", "hello"]
+
+    def __init__(self, tcp_stream):
+        self.tcp_stream = tcp_stream
+        # direction (src IP, src port) -> first sequence number seen in that direction
+        self.base_seqs = {}
+        # bytes of a ClientHello that spans several segments, and the sequence number of the next segment
+        self.hello = None
+
+
+class TcpStreamTracker(object):
+    """
+    Numbers TCP connections the way tshark numbers them in tcp.stream, and reassembles the ClientHellos sent on them.
+    """
+
+    def __init__(self):
+        # (endpoint, endpoint) with the lowest endpoint first -> _Connection
+        self.connections = {}
+        self.stream_count = 0
+
+    def get_connection(self, src, dst, seq, flags):
+        """
+        :param src: the (IP, port) tuple of the sender
+        :param dst: the (IP, port) tuple of the receiver
+        :return: the _Connection of the segment
+        """
+        key = (src, dst) if src <= dst else (dst, src)
+        connection = self.connections.get(key)
+        # A SYN with another initial sequence number than the first one seen starts a new connection on the same ports
+        is_syn = flags & (TCP_SYN | TCP_ACK) == TCP_SYN
+        if connection is None or (is_syn and connection.base_seqs.get(src, seq) != seq):
+            connection = _Connection(self.stream_count)
+            self.stream_count += 1
+            self.connections[key] = connection
+        connection.base_seqs.setdefault(src, seq)
+        return connection
+
+
+def iter_client_hellos(pcap_file):
+    """
+    :param pcap_file: path of a PCAPNG file
+    :return: a generator of ClientHello tuples for the TLS ClientHellos with a server name, in the order of the frames
+             that complete them
+    """
+    tracker = TcpStreamTracker()
+    for packet in iter_packets(pcap_file):
+        segment = parse_tcp_segment(packet.link_type, packet.data)
+        if segment is None:
+            continue
+        _, src_ip, dst_ip, src_port, dst_port, seq, flags, payload = segment
+        connection = tracker.get_connection((src_ip, src_port), (dst_ip, dst_port), seq, flags)
+        if not payload:
+            continue
+
+        if connection.hello is not None:
+            hello, next_seq = connection.hello
+            if seq != next_seq:
+                # Retransmission or out of order segment
+                continue
+            record = hello + payload
+        elif payload[0] == TLS_CONTENT_HANDSHAKE and len(payload) > TLS_RECORD_HEADER_LENGTH and \
+                payload[TLS_RECORD_HEADER_LENGTH] == TLS_HANDSHAKE_CLIENT_HELLO:
+            record = payload
+        else:
+            continue
+
+        record_length = TLS_RECORD_HEADER_LENGTH + struct.unpack_from("!H", record, 3)[0]
+        if len(record) < record_length:
+            # Wait for the next segments, like tshark does when it reassembles TCP streams
+            connection.hello = (record, (seq + len(payload)) & 0xFFFFFFFF) \
+                if record_length <= MAX_CLIENT_HELLO_LENGTH else None
+            continue
+        connection.hello = None
+
+        server_name = get_server_name(record[:record_length])
+        if server_name is not None:
+            yield ClientHello(packet.frame_number, packet.ts, packet.comment, src_ip, dst_ip, src_port, dst_port,
+                              connection.tcp_stream, server_name)
+
+
+def compare_with_tshark(pcap_file):
+    """
+    Extracts the TLS packets of a PCAPNG file with this reader and with tshark, and prints their differences.
+    :return: True if both give the same packets
+    """
+    # Only needed here, extract_from_tshark imports this module
+    import extract_from_tshark
+    import json_keys
+
+    extractor = extract_from_tshark.Extractor()
+    tshark_packets = {}
+    for key, packet in extractor.extract_packets(extract_from_tshark.iter_tshark_pipe(pcap_file), False):
+        if packet.get(json_keys.protocol) == json_keys.ssl:
+            tshark_packets[key] = packet
+    native_packets = dict(extractor.extract_native_tls_packets(pcap_file, set()))
+
+    same = True
+    for key in sorted(set(tshark_packets) | set(native_packets)):
+        if tshark_packets.get(key) != native_packets.get(key):
+            same = False
+            print("Frame %d:" % (key >> 1))
+            print("  tshark: " + json.dumps(tshark_packets.get(key), sort_keys=True))
+            print("  native: " + json.dumps(native_packets.get(key), sort_keys=True))
+    print("%d TLS packets from tshark, %d from the native reader, %s" %
+          (len(tshark_packets), len(native_packets), "same packets" if same else "DIFFERENT packets"))
+    return same
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Prints the TLS ClientHellos with a server name of a PCAPNG file, "
+                                             "without running tshark.")
+    ap.add_argument("pcap_file", help="PCAPNG file, e.g., a merged -ENC-out.pcapng trace")
+    ap.add_argument("--compare", action="store_true",
+                    help="Compare the TLS packets extracted from the file with the ones extracted by tshark instead "
+                         "(needs tshark)")
+    args = ap.parse_args()
+
+    if args.compare:
+        if not compare_with_tshark(args.pcap_file):
+            sys.exit(1)
+    else:
+        for client_hello in iter_client_hellos(args.pcap_file):
+            print(json.dumps(client_hello._asdict()))
@@ -12,8 +12,10 @@
 #
 # See the LICENSE.md file along with OVRseen for more details.
 
-import hashlib, copy, re
+import hashlib, re
 import json_keys
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
 from urllib.parse import unquote
 
 
@@ -25,9 +27,17 @@ class PIIHelper(object):
     PII_KEY_LOCATION = "Location"
     REDACT_PREFIX = "REDACTED_"
     REDACT_LOCATION = REDACT_PREFIX + PII_KEY_LOCATION.upper()
+    REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+    URL_ENCODED_RE = re.compile(r'%[0-9a-f]')
+    # A decimal number that can be a latitude or longitude: not part of a longer number, or of a version string
+    COORDINATE_RE = re.compile(r'-?(?<![\d.])\d{1,3}\.\d+(?!\.?\d)')
 
+    # Results for strings longer than this are not cached: they are mostly bodies, which rarely repeat
+    MAX_CACHED_VALUE_LENGTH = 4096
+    DEFAULT_CACHE_SIZE = 100000
 
-    def __init__(self, pii_dict, location_coords, should_redact=False):
+
+    def __init__(self, pii_dict, location_coords, should_redact=False, cache_size=DEFAULT_CACHE_SIZE):
         """
         :param pii_dict: dictionary containing pii type and its value.
             Both type and value must be of type string. Example:
@@ -35,14 +45,22 @@ class PIIHelper(object):
                 "Device ID": "1234",
                 "IMEI": "0987"
             }
-        :param location_coords: a list of tuples of (latitude, longitude) coordinates. Example:
+        :param location_coords: a list of tuples of (latitude, longitude) coordinates, as strings. A coordinate
+            also matches more precise numbers that truncate or round to it. Example:
             [("33.64", "-117.84"), ("33.6", "-117.8")]
+        :param cache_size: maximum number of strings whose results are kept in the LRU cache (0 disables it)
         """
         self.pii_redact_values = {}
         self.pii_dict = {}
-        self.location_coords = location_coords
+        self.location_coords = [tuple(coords) for coords in location_coords]
         self.should_redact = should_redact
 
+        # LRU cache of (value, override_redacting, url_decoding) -> (redacted value, tuple of found PII types)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         for pii_key in pii_dict:
             # Add md5 and sha1 hashes to values to search for
             pii_value = pii_dict[pii_key]
@@ -55,6 +73,67 @@ class PIIHelper(object):
             self.pii_redact_values[pii_key] = PIIHelper.REDACT_PREFIX + \
                                               pii_key.upper().replace(" ", "_")
 
+        # redact from longer to shorter PII values
+        self.pii_keys_by_length = [pii_key for pii_key, _ in
+                                   sorted(self.pii_dict.items(), key=lambda t: -len(t[1][0]))]
+
+        # Pre-compile every PII value (and its hashes) once. Values without regex syntax are matched with a plain
+        # substring test on the lower-cased string, which is much cheaper than a regex search.
+        self.pii_matchers = {}
+        for pii_key, pii_values in self.pii_dict.items():
+            self.pii_matchers[pii_key] = [(pii_value,
+                                           re.compile(pii_value, re.I),
+                                           pii_value.lower() if PIIHelper._is_literal(pii_value) else None)
+                                          for pii_value in pii_values]
+
+        # A single alternation of all PII values: most strings contain no PII at all, and this lets us rule them
+        # out with one scan instead of one scan per PII value.
+        all_pii_values = [pii_value for pii_key in self.pii_keys_by_length for pii_value in self.pii_dict[pii_key]]
+        self.any_pii_re = re.compile("|".join("(?:" + v + ")" for v in all_pii_values), re.I) \
+            if all_pii_values else None
+
+        # Index the location coordinates by precision (number of decimals) and then by value, so that a number
+        # found in a string can be looked up without going through all known coordinates
+        self.location_index = {}
+        for pair_index, coords in enumerate(self.location_coords):
+            for coord_index, coord in enumerate(coords):
+                precision = len(coord) - coord.index(".") - 1 if "." in coord else 0
+                self.location_index.setdefault(precision, {}) \
+                    .setdefault(PIIHelper._normalize_coordinate(coord), set()).add((pair_index, coord_index))
+
+
+    @staticmethod
+    def _is_literal(pii_value):
+        return not any(c in PIIHelper.REGEX_SPECIAL_CHARS for c in pii_value)
+
+
+    def _is_cacheable(self, value):
+        return self.cache_size > 0 and isinstance(value, str) and len(value) <= PIIHelper.MAX_CACHED_VALUE_LENGTH
+
+
+    def _cache_get(self, cache_key):
+        result = self.cache.get(cache_key)
+        if result is None:
+            self.cache_misses += 1
+            return None
+        self.cache.move_to_end(cache_key)
+        self.cache_hits += 1
+        return result[0], list(result[1])
+
+
+    def _cache_put(self, cache_key, updated_value, pii_keys_found):
+        self.cache[cache_key] = (updated_value, tuple(pii_keys_found))
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+    def cache_info(self):
+        """
+        :return: a dictionary with the number of cache hits and misses, and the current and maximum cache size
+        """
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self.cache), "max_size": self.cache_size}
+
 
     def _is_numeric(self, value):
         return isinstance(value, int) or isinstance(value, float)
@@ -77,95 +156,152 @@ class PIIHelper(object):
                 pass
 
 
-    def _contains_pii(self, value, pii_key, override_redacting=False):
+    def _contains_pii(self, value, pii_key, override_redacting=False, lower_value=None):
         """
         Finds the pii that may be inside "value".
         :param value: string that we search for pii
         :param pii_key: pii (key in the self.pii_dict) to search for
+        :param lower_value: value.lower(), if the caller already computed it
         :return: a tuple - (boolean indicating whether the provided pii was found,
                             the provided value with any PII redacted)
         """
         updated_value = value
         pii_found = False
+        is_numeric = self._is_numeric(updated_value)
+        if not is_numeric and lower_value is None:
+            lower_value = updated_value.lower()
 
-        for pii_value in self.pii_dict[pii_key]:
+        for pii_value, pii_re, pii_literal in self.pii_matchers[pii_key]:
             match = False
-            if self._is_numeric(updated_value):
+            if is_numeric:
                 numeric_pii_value = self._get_numberic_value(pii_value, updated_value)
                 if numeric_pii_value is not None:
                     match = numeric_pii_value == updated_value
+            elif pii_literal is not None:
+                match = pii_literal in lower_value
             else:
-                #match = pii_value.lower() in updated_value.lower()
-                match = re.search(pii_value, updated_value, re.I)
+                match = pii_re.search(updated_value)
 
             if match:
                 pii_found = True
                 if self.should_redact and not override_redacting:
                     redact_value = self.pii_redact_values[pii_key]
-                    #updated_value = updated_value.replace(pii_value, redact_value)
                     # use case insenstive redacting
-                    updated_value = re.sub(pii_value, redact_value, updated_value, flags=re.I)
+                    updated_value = pii_re.sub(redact_value, updated_value)
+                    lower_value = updated_value.lower()
 
         return updated_value, pii_found
 
 
     def _contains_location_pii_type(self, value):
         """
-        Finds and redacts location coordinates that may be inside "value".
+        Finds and redacts location coordinates that may be inside "value". All decimal numbers in the value are
+        found with one regex scan and looked up in the coordinate index, so the cost does not depend on the number
+        of known coordinates. A location is only reported if both coordinates of a pair are found.
         :param value: string that we search for pii
         :return: a tuple - (boolean indicating whether location was found,
                             the provided value with any PII redacted)
         """
         # to compare both lat and longitude, the value needs to be a string
         pii_found = False
-        if self._is_numeric(value):
+        if not self.location_index or self._is_numeric(value):
             return value, pii_found
 
-        updated_value = value
-        for latitude, longitude in self.location_coords:
-            if latitude in updated_value and longitude in updated_value:
+        # pair -> set of its coordinates found so far, and the spans of the numbers that matched each pair
+        found_coords = {}
+        found_spans = {}
+        for match in PIIHelper.COORDINATE_RE.finditer(value):
+            for pair_index, coord_index in self._lookup_coordinate(match.group()):
+                found_coords.setdefault(pair_index, set()).add(coord_index)
+                found_spans.setdefault(pair_index, []).append(match.span())
+
+        spans = set()
+        for pair_index, coord_indexes in found_coords.items():
+            if len(coord_indexes) == len(self.location_coords[pair_index]):
                 pii_found = True
-                if self.should_redact:
-                    updated_value = updated_value.replace(latitude, PIIHelper.REDACT_LOCATION)
-                    updated_value = updated_value.replace(longitude, PIIHelper.REDACT_LOCATION)
+                spans.update(found_spans[pair_index])
 
-        return updated_value, pii_found
+        if pii_found and self.should_redact:
+            parts = []
+            last_end = 0
+            for start, end in sorted(spans):
+                parts.append(value[last_end:start])
+                parts.append(PIIHelper.REDACT_LOCATION)
+                last_end = end
+            parts.append(value[last_end:])
+            return "".join(parts), pii_found
 
+        return value, pii_found
 
-    def get_pii_from_str(self, value, override_redacting=False, url_decoding=True):
+
+    def _lookup_coordinate(self, number):
         """
-        Finds PII in the provided value (must be of string type)
-        :return: a tuple - (the provided value with any PII redacted, the list of found PII types)
+        Looks up a decimal number (as found by COORDINATE_RE) in the coordinate index. The number matches a known
+        coordinate if it is equal to it once truncated or rounded to the precision of that coordinate.
+        :return: a set of (pair index, coordinate index) of the known coordinates that the number matches
         """
+        matches = set()
+        number_precision = len(number) - number.index(".") - 1
+        for precision, coords in self.location_index.items():
+            if precision > number_precision:
+                continue
+            if precision == number_precision:
+                matches.update(coords.get(PIIHelper._normalize_coordinate(number), ()))
+                continue
+            # truncated: drop the extra digits
+            truncated = number[:len(number) - number_precision + precision]
+            matches.update(coords.get(PIIHelper._normalize_coordinate(truncated), ()))
+            # rounded
+            matches.update(coords.get(PIIHelper._round_coordinate(number, precision), ()))
+        return matches
 
-        new_value = value
 
-        # do nothing for this case
-        if value is None:
-            return value, []
+    @staticmethod
+    def _normalize_coordinate(number):
+        return str(Decimal(number))
 
-        # may need to convert unicode (python2)
-        #if isinstance(value, unicode):
-        #    new_value = value.encode("utf-8")
 
-        # may need to decode
-        if url_decoding and re.search(r'%[0-9a-f]', new_value):
+    @staticmethod
+    def _round_coordinate(number, precision):
+        return str(Decimal(number).quantize(Decimal(1).scaleb(-precision), rounding=ROUND_HALF_UP))
+
+
+    def _url_decode(self, value):
+        """
+        URL-decodes the value if it looks URL-encoded.
+        """
+        if PIIHelper.URL_ENCODED_RE.search(value):
             try:
-                #print("trying to decode string %s", new_value)
-                new_value = unquote(new_value)
-                #print("new string after decoding %s", new_value)
+                return unquote(value)
             except Exception as e:
                 print(str(e))
-                pass
+        return value
 
+
+    def _get_pii_from_decoded_str(self, value, override_redacting=False, may_contain_pii=True):
+        """
+        Finds PII in the provided value, which has already been URL-decoded if needed.
+        :param may_contain_pii: False if the caller already knows that no PII value (other than locations) can be
+                                found in value, e.g., thanks to a combined scan over several values
+        :return: a tuple - (the provided value with any PII redacted, the list of found PII types)
+        """
         pii_keys_found = []
-        updated_value = new_value
-        # redact from longer to shorter PII values
-        for pii_key, _ in sorted(self.pii_dict.items(), key=lambda t: -len(t[1][0])):
-            # find regular pii
-            updated_value, pii_found = self._contains_pii(updated_value, pii_key, override_redacting=override_redacting)
-            if pii_found:
-                pii_keys_found.append(pii_key)
+        updated_value = value
+        # Only look for each PII individually (to know which ones are there and redact them in order)
+        # if the combined scan found any PII at all
+        if self._is_numeric(updated_value) or (may_contain_pii and self.any_pii_re is not None and
+                                               self.any_pii_re.search(updated_value)):
+            lower_value = None if self._is_numeric(updated_value) else updated_value.lower()
+            # redact from longer to shorter PII values
+            for pii_key in self.pii_keys_by_length:
+                # find regular pii
+                updated_value, pii_found = self._contains_pii(updated_value, pii_key,
+                                                              override_redacting=override_redacting,
+                                                              lower_value=lower_value)
+                if pii_found:
+                    pii_keys_found.append(pii_key)
+                    if lower_value is not None:
+                        lower_value = updated_value.lower()
 
         updated_value, location_found = self._contains_location_pii_type(updated_value)
         if location_found:
@@ -174,31 +310,150 @@ class PIIHelper(object):
         return updated_value, pii_keys_found
 
 
+    def get_pii_from_str(self, value, override_redacting=False, url_decoding=True):
+        """
+        Finds PII in the provided value (must be of string type)
+        :return: a tuple - (the provided value with any PII redacted, the list of found PII types)
+        """
+        # do nothing for this case
+        if value is None:
+            return value, []
+
+        cacheable = self._is_cacheable(value)
+        if cacheable:
+            cache_key = (value, override_redacting, url_decoding)
+            result = self._cache_get(cache_key)
+            if result is not None:
+                return result
+
+        # may need to decode
+        new_value = self._url_decode(value) if url_decoding else value
+
+        updated_value, pii_keys_found = self._get_pii_from_decoded_str(new_value, override_redacting=override_redacting)
+        if cacheable:
+            self._cache_put(cache_key, updated_value, pii_keys_found)
+        return updated_value, pii_keys_found
+
+
+    def get_pii_from_packet(self, json_data, body=None):
+        """
+        Finds PII in a whole packet (NoMoAds format expected): the URI, all HTTP header keys and values, and
+        optionally the body that goes with the packet. Each string is URL-decoded at most once, and all strings
+        are first scanned together so that packets without PII are ruled out with a single scan.
+        The provided data is not modified: only the fields that may get redacted are copied.
+        :param json_data: the packet in NoMoAds format
+        :param body: the HTTP body of the packet, or None
+        :return: a tuple - (the provided data with any PII redacted, the body with any PII redacted,
+                            the list of found PII types)
+        """
+        headers = json_data[json_keys.headers]
+        # (value, override_redacting, url_decoding) for the URI, the body, and then each header key and value.
+        # Don't url_decoding the URI just in case we mess up the path; header keys are never redacted.
+        uri = json_data.get(json_keys.uri)
+        to_scan = [(uri, False, False), (body, False, True)]
+        for header_key, header_value in headers.items():
+            to_scan.append((header_key, True, True))
+            to_scan.append((header_value, False, True))
+
+        # Look up the cache first, and only decode and scan the strings that are not in it
+        results = [None] * len(to_scan)
+        decoded = {}
+        for i, (value, override_redacting, url_decoding) in enumerate(to_scan):
+            if value is None:
+                results[i] = (value, [])
+                continue
+            if self._is_cacheable(value):
+                results[i] = self._cache_get((value, override_redacting, url_decoding))
+            if results[i] is None:
+                decoded[i] = self._url_decode(value) if url_decoding else value
+
+        if decoded:
+            strings = [value for value in decoded.values() if isinstance(value, str)]
+            may_contain_pii = self.any_pii_re is not None and \
+                              self.any_pii_re.search("\n".join(strings)) is not None
+            for i, value in decoded.items():
+                original_value, override_redacting, url_decoding = to_scan[i]
+                updated_value, pii_keys_found = self._get_pii_from_decoded_str(
+                    value, override_redacting=override_redacting, may_contain_pii=may_contain_pii)
+                if self._is_cacheable(original_value):
+                    self._cache_put((original_value, override_redacting, url_decoding), updated_value, pii_keys_found)
+                results[i] = (updated_value, pii_keys_found)
+
+        redacted_data = dict(json_data)
+        redacted_data[json_keys.uri] = results[0][0] if uri is not None else ""
+        redacted_body, body_pii_keys_found = results[1]
+
+        redacted_headers = {}
+        pii_keys_found = list(results[0][1])
+        for i, header_key in enumerate(headers):
+            pii_keys_found += results[2 + 2 * i][1]
+            redacted_headers[header_key], header_pii_keys_found = results[3 + 2 * i]
+            pii_keys_found += header_pii_keys_found
+        redacted_data[json_keys.headers] = redacted_headers
+
+        return redacted_data, redacted_body, body_pii_keys_found + list(set(pii_keys_found))
+
+
     def get_pii_from_data(self, json_data):
         """
         Finds PII in the provided JSON data (NoMoAds format expected).
         Currently this method searches for PII in the URI and all HTTP header values
         :return: a tuple - (the provided data with any PII redacted, the list of found PII types)
         """
-        redacted_data = copy.deepcopy(json_data) #  make sure we don't modify the original data
-        redacted_uri = ""
-        pii_keys_found = []
-        if json_keys.uri in json_data:
-            # don't url_decoding just in case we mess up the path
-            redacted_uri, uri_pii_keys_found = self.get_pii_from_str(json_data[json_keys.uri], url_decoding=False)
-            pii_keys_found += uri_pii_keys_found
-
-        redacted_data[json_keys.uri] = redacted_uri
-
-        for header_key in json_data[json_keys.headers]:
-            # look for PII by header_key, never redact
-            _, header_key_pii_keys_found = self.get_pii_from_str(header_key, override_redacting=True)
-            pii_keys_found += header_key_pii_keys_found
-
-            # look for PII in header values
-            redacted_header, header_pii_keys_found = self.get_pii_from_str(
-                                                        json_data[json_keys.headers][header_key])
-            redacted_data[json_keys.headers][header_key] = redacted_header
-            pii_keys_found += header_pii_keys_found
+        redacted_data, _, pii_keys_found = self.get_pii_from_packet(json_data)
+        return redacted_data, pii_keys_found
 
-        return redacted_data, list(set(pii_keys_found))
+
+class PIIProfiles(object):
+    """
+    Keeps one PIIHelper per device, so that packets are only searched for the PII of the device that produced
+    them (plus the PII common to all devices). Helpers are built the first time a device is seen.
+    """
+
+    def __init__(self, common_pii_dict, device_pii_dicts, location_coords, should_redact=False,
+                 cache_size=PIIHelper.DEFAULT_CACHE_SIZE):
+        """
+        :param common_pii_dict: dictionary of PII types and values to search for on all devices
+        :param device_pii_dicts: dictionary of device name -> dictionary of PII types and values of that device
+        :param location_coords: a list of tuples of (latitude, longitude) coordinates, see PIIHelper
+        :param cache_size: maximum size of the LRU cache of each helper, see PIIHelper
+        """
+        self.common_pii_dict = common_pii_dict
+        self.device_pii_dicts = device_pii_dicts
+        self.location_coords = location_coords
+        self.should_redact = should_redact
+        self.cache_size = cache_size
+        self.helpers = {}
+
+
+    def get_helper(self, device=None):
+        """
+        :param device: name of the device, or None if it is not known
+        :return: the PIIHelper for the given device. If the device is not known, the helper searches for the PII
+                 of all devices.
+        """
+        if device not in self.device_pii_dicts:
+            device = None
+
+        helper = self.helpers.get(device)
+        if helper is None:
+            pii_dict = {}
+            for device_name, device_pii_dict in self.device_pii_dicts.items():
+                if device is None or device_name == device:
+                    pii_dict.update(device_pii_dict)
+            pii_dict.update(self.common_pii_dict)
+            helper = PIIHelper(pii_dict, self.location_coords, should_redact=self.should_redact,
+                               cache_size=self.cache_size)
+            self.helpers[device] = helper
+        return helper
+
+
+    def cache_info(self):
+        """
+        :return: the cache statistics of all helpers added up, see PIIHelper.cache_info
+        """
+        info = {"hits": 0, "misses": 0, "size": 0, "max_size": 0}
+        for helper in self.helpers.values():
+            for key, value in helper.cache_info().items():
+                info[key] += value
+        return info
@@ -7,28 +7,209 @@ Basically, the scripts perform:
 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files.
 3) Produce a unified JSON file in NoMoAds-style.
 4) Run the unified JSON file through the filter-list matching script.
-5) Finally, produce a CSV file that contains the flow of traffic for further processing (e.g., ATS analyses, policy analyses, etc.)
+5) Finally, produce a CSV file that contains the flow of traffic of all apps for further processing (e.g., ATS analyses,
+   policy analyses, etc.)
 '''
 
 import argparse
 import os
+import sys
 import subprocess
 import shutil
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
 from utils.utils import DIR_DELIMITER
-from pandasql import sqldf
-pysqldf = lambda q: sqldf(q, globals())
+from merge_cap import get_files_to_merge
+from stage_manifest import StageManifest
+from packet_store import PARQUET_EXTENSION
+from extract_from_tshark import Extractor
+import compare_results
+from append_sld_to_csv import append_sld
 
 # Filter list result directory
 FL_RESULT_DIR = "filters_matching_results"
+FILTER_LISTS_DIR = "filter_lists"
+
+# Scripts run by each stage; they are inputs of their stages, so changing them reruns the stage
+MERGE_CAP_SCRIPT = "merge_cap.py"
+EXTRACT_SCRIPTS = ["extract_from_tshark.py", "pii_helper.py", "json_keys.py", "packet_store.py", "pcapng_reader.py"]
+FILTER_CHECKER_SCRIPT = "filter_list_checker_mult_dirs.py"
+FILTER_CHECKER_SCRIPTS = [FILTER_CHECKER_SCRIPT, "filter_list_engine.py", "packet_store.py"]
+COMPARE_RESULTS_SCRIPT = "compare_results.py"
+FINAL_STAGE_SCRIPTS = ["process_pcaps.py", COMPARE_RESULTS_SCRIPT, "packet_store.py", "append_sld_to_csv.py",
+                       "public_suffix.py", "oculus_hostname_fp_tp_csv_generator.py", "aggregate_flows.py"]
+
+# Block decisions of the filter lists are cached across runs and app stores in this file, in the dataset root
+BLOCK_DECISION_CACHE_DB = "block_decisions.sqlite"
+
+# CSVs about app stores that are joined with the traffic data
+APP_STORE_CSVS = ["all_150_top_apps.csv", "oculus_store_apps.csv", "sidequest_store_apps.csv"]
+
+
+def get_nomoads_file_name(apk_dir, parquet=False):
+    """
+    :return: the name of the NoMoAds file of an app: a json file, or a Parquet packet store
+    """
+    return apk_dir + "-out-nomoads" + (PARQUET_EXTENSION if parquet else ".json")
+
+
+# Extractor of the current process, kept across the apps that the process extracts
+_extractor = None
+
+
+def get_extractor():
+    """
+    :return: the Extractor of the current process, e.g., of a worker of the app pool, so that the PII helpers are
+             only set up once per process instead of once per app
+    """
+    global _extractor
+    if _extractor is None:
+        _extractor = Extractor(include_http_body=True)
+    return _extractor
+
+
+def run_app_pipeline(app_store_name, apk_dir_path, apk_dir, tshark_pipe=False, parquet=False, force=False,
+                     parallel_extract=False, native_tls=False):
+    """
+    Runs the per-app part of the pipeline (steps 1 to 3) for one APK directory.
+    Stages whose inputs did not change since the last run are skipped, unless force is set.
+    :param app_store_name: name of the app store, used for logging
+    :param apk_dir_path: absolute path of the APK directory that contains the PCAP files
+    :param apk_dir: name of the APK directory
+    :param tshark_pipe: whether tshark is run by the extraction step instead of writing JSON files
+    :param parquet: whether packets are stored in a Parquet packet store instead of a NoMoAds json file
+    :param force: whether to run all stages regardless of the stage manifest
+    :param parallel_extract: whether the encrypted and the decrypted trace are extracted at the same time
+    :param native_tls: whether the TLS packets of the encrypted trace are read by pcapng_reader.py instead of tshark
+    :return: the (apk_dir_path, apk_dir) tuple of the processed app
+    """
+    print(f"[.] {app_store_name}: Begin the pipeline for app " + apk_dir + "...\n")
+    manifest = StageManifest(apk_dir_path)
+    params = {"tshark_pipe": tshark_pipe}
+
+    # The pipeline
+    # 1) Merge PCAP files for each app into one PCAP file for encrypted traffic and
+    #    one PCAP file for decrypted traffic.
+    # 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files.
+    #    In pipe mode, tshark is instead run by the extraction step in 3).
+    # The decrypted and encrypted traces are independent, so both are processed at the same time.
+    tshark_ext = ".pcapng" if tshark_pipe else ".json"
+    merge_stages = []
+    for encdec, suffix in [("-dec", "-DEC-out"), ("-enc", "-ENC-out")]:
+        stage = "merge" + encdec
+        inputs = [os.path.join(apk_dir_path, fn) for fn in sorted(get_files_to_merge(encdec, apk_dir_path))]
+        inputs.append(MERGE_CAP_SCRIPT)
+        outputs = [os.path.join(apk_dir_path, apk_dir + suffix + ".pcapng")]
+        if not tshark_pipe:
+            outputs.append(os.path.join(apk_dir_path, apk_dir + suffix + ".json"))
+        if not force and manifest.is_fresh(stage, inputs, outputs, params):
+            print(f"[=] {app_store_name}: Skipping {stage} for app {apk_dir}, inputs did not change")
+            continue
+        manifest.invalidate(stage)
+        merge_stages.append((stage, inputs, outputs, encdec))
+
+    if merge_stages:
+        merge_cmd_suffix = ["--merge-only"] if tshark_pipe else []
+        print(f"[+] {app_store_name}: Merging PCAP files and creating JSON files using tshark...")
+        merge_procs = [subprocess.Popen(["python3", MERGE_CAP_SCRIPT, encdec, apk_dir_path] + merge_cmd_suffix)
+                       for _, _, _, encdec in merge_stages]
+        for proc in merge_procs:
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        for stage, inputs, outputs, _ in merge_stages:
+            manifest.record(stage, inputs, outputs, params)
+
+    # 3) Produce a unified JSON file in NoMoAds-style.
+    enc_file = os.path.join(apk_dir_path, apk_dir + "-ENC-out" + tshark_ext)
+    dec_file = os.path.join(apk_dir_path, apk_dir + "-DEC-out" + tshark_ext)
+    out_file = os.path.join(apk_dir_path, get_nomoads_file_name(apk_dir, parquet))
+    inputs = [enc_file, dec_file] + EXTRACT_SCRIPTS
+    # The later stages pick up NoMoAds files of both formats: remove those left in the other format by earlier runs
+    for stale_file in [os.path.join(apk_dir_path, get_nomoads_file_name(apk_dir, not parquet)),
+                       os.path.join(apk_dir_path, FL_RESULT_DIR, get_nomoads_file_name(apk_dir, not parquet))]:
+        if os.path.isfile(stale_file):
+            os.remove(stale_file)
+    extract_params = dict(params, native_tls=True) if native_tls else params
+    if not force and manifest.is_fresh("extract", inputs, [out_file], extract_params):
+        print(f"[=] {app_store_name}: Skipping extraction for app {apk_dir}, inputs did not change")
+        return apk_dir_path, apk_dir
+
+    manifest.invalidate("extract")
+    print(f"[+] {app_store_name}: Creating a unified JSON file...\n")
+    get_extractor().extract(enc_file, dec_file, out_file, streaming=True, from_pcap=tshark_pipe,
+                            out_format="parquet" if parquet else "json", parallel=parallel_extract,
+                            native_tls=native_tls)
+    manifest.record("extract", inputs, [out_file], extract_params)
+
+    return apk_dir_path, apk_dir
+
+
+def get_filter_match_files(apk_dir_path, apk_dir, parquet=False):
+    """
+    :return: the input and output files of the filter-list matching stage of one app
+    """
+    inputs = [os.path.join(apk_dir_path, get_nomoads_file_name(apk_dir, parquet))] + FILTER_CHECKER_SCRIPTS + \
+             get_filter_list_files()
+    outputs = [os.path.join(apk_dir_path, FL_RESULT_DIR, get_nomoads_file_name(apk_dir, parquet))]
+    return inputs, outputs
+
+
+def get_filter_list_files():
+    return sorted(os.path.join(FILTER_LISTS_DIR, fn) for fn in os.listdir(FILTER_LISTS_DIR) if "DS_Store" not in fn)
+
+
+def left_join(left, right, key, right_key, columns):
+    """
+    Left joins columns of a small table (e.g., about apps) onto a large one (e.g., packets) with the semantics of a
+    SQL left join: rows whose key is missing on either side get no match, and rows matching several rows of the small
+    table are repeated. The keys are joined as categoricals with the same categories, i.e., on integer codes.
+    :param left: the large DataFrame; its key column should already be categorical, otherwise left is copied
+    :param right: the small DataFrame
+    :param key: the name of the key column in left
+    :param right_key: the name of the key column in right
+    :param columns: dict of the names of the columns of right to add -> their names in the result
+    :return: the joined DataFrame, with the rows in the order of left
+    """
+    if not isinstance(left[key].dtype, pd.CategoricalDtype):
+        left = left.astype({key: "category"})
+    right = right[[right_key] + list(columns)].rename(columns=dict(columns, **{right_key: key}))
+    # Values of right that are not in left become NaN here, and could not have matched anyway
+    right[key] = pd.Categorical(right[key], dtype=left[key].dtype)
+    right = right.dropna(subset=[key])
+    return left.merge(right, how="left", on=key, sort=False)
+
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description='Runs the full Oculus pipeline')
     ap.add_argument('dataset_root_dir', type=str, help='root directory of dataset')
     ap.add_argument('app_store_csvs_dir', type=str, help='directory of csvs about app stores')
+    ap.add_argument('--tshark_pipe', action="store_true",
+                    help='run tshark from the extraction step and read its output directly instead of '
+                         'writing intermediate tshark JSON files')
+    ap.add_argument('--parquet', action="store_true",
+                    help='store the packets of each app in a Parquet packet store instead of a NoMoAds json file '
+                         '(needs pyarrow)')
+    ap.add_argument('--jobs', type=int, default=1,
+                    help='number of apps to process concurrently, and of workers that match them against '
+                         'filter lists (default: 1)')
+    ap.add_argument('--force', action="store_true",
+                    help='recompute every stage instead of only the stages whose inputs changed since the last run')
+    ap.add_argument('--parallel_extract', action="store_true",
+                    help='with --tshark_pipe, extract the encrypted and the decrypted trace of each app at the same '
+                         'time, with a second process per app')
+    ap.add_argument('--native_tls', action="store_true",
+                    help='with --tshark_pipe, read the TLS packets of the encrypted traces with pcapng_reader.py '
+                         'instead of tshark')
+    ap.add_argument('--flows', action="store_true",
+                    help='write one row per flow, i.e., per (tcp.stream, host) of an app, in the final CSV instead '
+                         'of one row per packet')
 
     args = ap.parse_args()
+    if args.native_tls and not args.tshark_pipe:
+        ap.error("--native_tls needs --tshark_pipe")
+    if args.parallel_extract and not args.tshark_pipe:
+        ap.error("--parallel_extract needs --tshark_pipe")
 
     # Get the absolute paths
     dataset_root_abs_dir = os.path.abspath(args.dataset_root_dir)
@@ -37,23 +218,31 @@ if __name__ == '__main__':
     TEMP_OUTPUT_NAME = "temp_output"
     CSV_TMP_NAME = "csv"
     output_tmp_dir = dataset_root_abs_dir + os.sep + TEMP_OUTPUT_NAME
-    if os.path.isdir(output_tmp_dir):
+    if args.force and os.path.isdir(output_tmp_dir):
         shutil.rmtree(output_tmp_dir)
-    os.makedirs(output_tmp_dir)
+    os.makedirs(output_tmp_dir, exist_ok=True)
+
+    # keep track of the filter-list matching results of the apps, per store
+    fl_result_dirs_per_store = []
 
-    # keep track of dfs per store
-    data_frames = []
+    pool = ProcessPoolExecutor(max_workers=max(1, args.jobs))
 
     # For each app store:
-    #   Iterate over APK subdirectories that contain the PCAP files and call the necessary scripts
+    #   Iterate over APK subdirectories that contain the PCAP files and schedule the per-app steps.
+    #   Apps of all app stores are submitted at once so that the pool stays busy while the
+    #   store-level steps below wait for the apps of one store.
+    app_store_futures = []
     for app_store_name in os.listdir(dataset_root_abs_dir):
 
         if app_store_name == ".DS_Store" or app_store_name == TEMP_OUTPUT_NAME:
             continue
 
-        apk_dir_path_tuple = []
         app_store_dir = os.path.join(dataset_root_abs_dir, app_store_name)
+        if not os.path.isdir(app_store_dir):
+            # e.g., the final CSV file of a previous run
+            continue
         print(f"Processing data from App Store: {app_store_name}")
+        app_futures = []
         for apk_dir in os.listdir(app_store_dir):
 
             if apk_dir == ".DS_Store" or apk_dir == CSV_TMP_NAME:
@@ -64,107 +253,105 @@ if __name__ == '__main__':
             if apk_dir == '__MACOSX' or not os.path.isdir(apk_dir_path):
                 continue
 
-            print(f"[.] {app_store_name}: Begin the pipeline for app " + apk_dir + "...\n")
-
-            # The pipeline
-            # 1) Merge PCAP files for each app into one PCAP file for encrypted traffic and
-            #    one PCAP file for decrypted traffic.
-            # 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files.
-            print(f"[+] {app_store_name}: Merging decrypted PCAP files and creating a JSON file using tshark...")
-            ret = subprocess.check_call(["python3", "merge_cap.py", "-dec", apk_dir_path])
-            print(f"[+] {app_store_name}: Merging encrypted PCAP files and creating a JSON file using tshark...")
-            ret = subprocess.check_call(["python3", "merge_cap.py", "-enc", apk_dir_path])
-
-            # 3) Produce a unified JSON file in NoMoAds-style.
-            print(f"[+] {app_store_name}: Creating a unified JSON file...\n")
-            ret = subprocess.check_call(["python3", "extract_from_tshark.py",
-                "--enc_file",
-                os.path.join(apk_dir_path, apk_dir + "-ENC-out.json"),
-                "--dec_file",
-                os.path.join(apk_dir_path, apk_dir + "-DEC-out.json"),
-                "--out_file",
-                os.path.join(apk_dir_path, apk_dir + "-out-nomoads.json"),
-                "--include_http_body"
-                ])
-
-            apk_dir_path_tuple.append((apk_dir_path, apk_dir))
-
-        apk_dir_paths_only = [x for x, _ in apk_dir_path_tuple]
+            app_futures.append(pool.submit(run_app_pipeline, app_store_name, apk_dir_path, apk_dir,
+                                           tshark_pipe=args.tshark_pipe, parquet=args.parquet, force=args.force,
+                                           parallel_extract=args.parallel_extract, native_tls=args.native_tls))
+
+        app_store_futures.append((app_store_name, app_store_dir, app_futures))
+
+    for app_store_name, app_store_dir, app_futures in app_store_futures:
+        # Filter-list matching works on all apps of a store at once, so wait for them here
+        apk_dir_path_tuple = [future.result() for future in app_futures]
+
+        # Only apps whose NoMoAds JSON or filter lists changed need to be matched again
+        stale_filter_match = []
+        for apk_dir_path, apk_dir in apk_dir_path_tuple:
+            inputs, outputs = get_filter_match_files(apk_dir_path, apk_dir, args.parquet)
+            manifest = StageManifest(apk_dir_path)
+            if args.force or not manifest.is_fresh("filter_match", inputs, outputs):
+                manifest.invalidate("filter_match")
+                stale_filter_match.append((apk_dir_path, apk_dir))
+        apk_dir_paths_only = [x for x, _ in stale_filter_match]
 
         # 4) Run the unified JSON file through the filter-list matching script.
-        print(f"[+] {app_store_name}: Running the unified JSON file and matching the entries against filter lists...")
-        ret = subprocess.check_call(["python3", "filter_list_checker_mult_dirs.py", DIR_DELIMITER.join(apk_dir_paths_only), "filter_lists", FL_RESULT_DIR])
-        print("\n")
-        print(f"[+] {app_store_name}: Filter lists matching results are saved in " + DIR_DELIMITER.join(apk_dir_paths_only) + "...\n")
-
-        # Make CSV directory to hold output
-        csv_app_store_dir = app_store_dir + os.sep + "csv"
-        if not os.path.isdir(csv_app_store_dir):
-            os.makedirs(csv_app_store_dir, exist_ok=True)
-
-        # 5) Finally, produce a CSV file that contains the flow of traffic for further processing
-        #    (e.g., ATS analyses, policy analyses, etc.)
-        for apk_dir_path_tmp, apk_dir_tmp in apk_dir_path_tuple:
-            fl_result_dir = os.path.join(apk_dir_path_tmp, FL_RESULT_DIR)
-            print(f"[+] {app_store_name}: Generating the final CSV file in " + fl_result_dir + "...\n")
-            csv_file_path = os.path.join(fl_result_dir, apk_dir_tmp + ".csv")
-            ret = subprocess.check_call([
-                "python3",
-                "compare_results.py", fl_result_dir,
-                "filter_lists", csv_file_path,
-                "--include_http_body"
-                ])
-            print(f"[+] {app_store_name}: Copying the final CSV file into " + csv_app_store_dir + "...\n\n")
-            shutil.copy(csv_file_path, csv_app_store_dir)
-
-        # merge csv into one per store
-        merged_file_one_store = os.path.join(output_tmp_dir, f"{app_store_name}-merged.csv")
-
-        cmd = f"awk '(NR == 1) || (FNR > 1)' *.csv > {merged_file_one_store}"
-        subprocess.check_output(cmd, shell=True, cwd=csv_app_store_dir)
-        print(f"[+] {app_store_name}: Created merged csv {merged_file_one_store}")
-
-        # add the app_store column with the name
-        df = pd.read_csv(merged_file_one_store)
-        df["app_store"] = app_store_name
-        data_frames.append(df)
-
-    # merge everything together
-    all_merged = pd.concat(data_frames)
+        if apk_dir_paths_only:
+            print(f"[+] {app_store_name}: Running the unified JSON file and matching the entries against filter lists...")
+            ret = subprocess.check_call(["python3", FILTER_CHECKER_SCRIPT, DIR_DELIMITER.join(apk_dir_paths_only), FILTER_LISTS_DIR, FL_RESULT_DIR,
+                                         "--cache_db", os.path.join(args.dataset_root_dir, BLOCK_DECISION_CACHE_DB),
+                                         "--jobs", str(args.jobs)])
+            print("\n")
+            print(f"[+] {app_store_name}: Filter lists matching results are saved in " + DIR_DELIMITER.join(apk_dir_paths_only) + "...\n")
+            for apk_dir_path, apk_dir in stale_filter_match:
+                inputs, outputs = get_filter_match_files(apk_dir_path, apk_dir, args.parquet)
+                StageManifest(apk_dir_path).record("filter_match", inputs, outputs)
+        else:
+            print(f"[=] {app_store_name}: Skipping filter lists matching, inputs did not change")
+
+        fl_result_dirs_per_store.append(
+            (app_store_name, [os.path.join(apk_dir_path, FL_RESULT_DIR) for apk_dir_path, _ in apk_dir_path_tuple]))
+
+    pool.shutdown()
+
+    # The remaining steps work on the data of all app stores, so they rerun if anything above changed
+    final_manifest = StageManifest(output_tmp_dir)
+    all_merged_with_esld_engine_privacy_developer_party_file = output_tmp_dir + os.sep + "all-merged-with-esld-engine-privacy-developer-party.csv"
+    final_file = dataset_root_abs_dir + os.sep + os.path.basename(all_merged_with_esld_engine_privacy_developer_party_file)
+    annotated_files = [path for _, fl_result_dirs in fl_result_dirs_per_store for fl_result_dir in fl_result_dirs
+                       for _, path in compare_results.get_annotated_files(fl_result_dir)]
+    final_inputs = annotated_files + FINAL_STAGE_SCRIPTS + get_filter_list_files() + \
+                   [app_store_csvs_abs_dir + os.sep + fn for fn in APP_STORE_CSVS]
+    final_outputs = [all_merged_with_esld_engine_privacy_developer_party_file, final_file]
+    final_params = [app_store_name for app_store_name, _ in fl_result_dirs_per_store] + \
+                   (["flows"] if args.flows else [])
+    if not args.force and final_manifest.is_fresh("final", final_inputs, final_outputs, final_params):
+        print(f"Final CSV is up to date in {final_file}")
+        sys.exit(0)
+    final_manifest.invalidate("final")
+
+    # 5) Finally, produce a CSV file that contains the flow of traffic of all apps for further processing
+    #    (e.g., ATS analyses, policy analyses, etc.). The packets of every app are streamed into the same CSV file,
+    #    with the name of its app store in the app_store column. With --flows, the packets of each app are first
+    #    aggregated into flows, and the CSV file has one row per flow instead.
     all_merged_file = output_tmp_dir + os.sep + "all-merged.csv"
-    all_merged.to_csv(all_merged_file, index=False)
+    print(f"[+] Generating the CSV file of all apps in {all_merged_file}...\n")
+    fl_names = compare_results.get_filter_list_names(FILTER_LISTS_DIR)
+    compare_results.consolidate(fl_result_dirs_per_store, fl_names, all_merged_file, include_http_body=True,
+                                flows=args.flows)
 
     # add esld
-    all_merged_with_esld_file = output_tmp_dir + os.sep + "all-merged-with-esld.csv"
-    ret = subprocess.check_call(["python3", "append_sld_to_csv.py", all_merged_file, all_merged_with_esld_file])
+    all_merged_with_esld_df = append_sld(pd.read_csv(all_merged_file, dtype={"app_id": "category"}))
 
     # read in other CSVs
-    all_merged_with_esld_df = pd.read_csv(all_merged_with_esld_file)
-    all_150_top_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "all_150_top_apps.csv")
-    oculus_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "oculus_store_apps.csv")
-    sidequest_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "sidequest_store_apps.csv")
+    all_150_top_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + APP_STORE_CSVS[0],
+                                      dtype={"App_Title": "category"})
+    oculus_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + APP_STORE_CSVS[1],
+                                       dtype={"Developer": "category"})
+    sidequest_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + APP_STORE_CSVS[2],
+                                          dtype={"Creator": "category"})
 
     # add in app title,game engine, and developer privacy policy
-    all_merged_with_esld_engine_privacy_df = pysqldf("select merged.*, App_Title, Game_Engine, Actual_Developer_Privacy_Policy, Final_Status  from all_merged_with_esld_df  as merged left join all_150_top_apps_df as topapps on merged.app_id == topapps.package_name;")
+    all_merged_with_esld_engine_privacy_df = left_join(
+        all_merged_with_esld_df, all_150_top_apps_df, "app_id", "package_name",
+        {"App_Title": "App_Title", "Game_Engine": "Game_Engine",
+         "Actual_Developer_Privacy_Policy": "Actual_Developer_Privacy_Policy", "Final_Status": "Final_Status"})
 
     all_merged_with_esld_engine_privacy_df = all_merged_with_esld_engine_privacy_df[all_merged_with_esld_engine_privacy_df["Final_Status"] == "Working"]
 
     # add in developer name
-    sql_query = \
-        """
-        select ocmerged.*, oc.Developer as "oculus_creator", s.Creator as "sidequest_creator" from all_merged_with_esld_engine_privacy_df as ocmerged
-        left join oculus_store_apps_df as oc on ocmerged.App_Title == oc.App_Title
-        left join sidequest_store_apps_df as s on ocmerged.App_Title == s.App_Title;
-        """
-    all_merged_with_esld_engine_privacy_developer_df = pysqldf(sql_query)
+    all_merged_with_esld_engine_privacy_developer_df = left_join(
+        all_merged_with_esld_engine_privacy_df, oculus_store_apps_df, "App_Title", "App_Title",
+        {"Developer": "oculus_creator"})
+    all_merged_with_esld_engine_privacy_developer_df = left_join(
+        all_merged_with_esld_engine_privacy_developer_df, sidequest_store_apps_df, "App_Title", "App_Title",
+        {"Creator": "sidequest_creator"})
     all_merged_with_esld_engine_privacy_developer_file = output_tmp_dir + os.sep + "all-merged-with-esld-engine-privacy-developer.csv"
     all_merged_with_esld_engine_privacy_developer_df.to_csv(all_merged_with_esld_engine_privacy_developer_file,
                                                             index=False)
     # add party label
-    all_merged_with_esld_engine_privacy_developer_party_file = output_tmp_dir + os.sep + "all-merged-with-esld-engine-privacy-developer-party.csv"
     ret = subprocess.check_call(
         ["python3", "oculus_hostname_fp_tp_csv_generator.py", all_merged_with_esld_engine_privacy_developer_file, all_merged_with_esld_engine_privacy_developer_party_file])
 
     # copy final CSV to the root dir
     shutil.copy(all_merged_with_esld_engine_privacy_developer_party_file, dataset_root_abs_dir)
-    print(f"Final CSV is in {dataset_root_abs_dir + os.sep + os.path.basename(all_merged_with_esld_engine_privacy_developer_party_file)}")
+    final_manifest.record("final", final_inputs, final_outputs, final_params)
+    print(f"Final CSV is in {final_file}")
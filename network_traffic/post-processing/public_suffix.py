@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Offline public suffix lookups, shared by all the stages that need the registered domain (eSLD) of a hostname or URL.
+
+The rules come from the public suffix list snapshot bundled with tldextract, so lookups never go to the network and
+never write a cache on disk. The rules are loaded once per process into a trie keyed by the labels of a suffix from
+right to left, and the results of extract() are memoised. Results are the same as the ones of tldextract.extract
+(tldextract 3.1.2, which excludes the private domains of the list) when it falls back to its snapshot.
+"""
+
+import argparse
+import collections
+import pkgutil
+import re
+from functools import lru_cache
+
+import idna
+from tldextract.remote import SCHEME_RE, looks_like_ip
+
+# Package and resource of the bundled public suffix list snapshot
+SNAPSHOT_PACKAGE = "tldextract"
+SNAPSHOT_RESOURCE = ".tld_set_snapshot"
+
+# Same parsing of the list as tldextract
+PUBLIC_SUFFIX_RE = re.compile(r"^(?P<suffix>[.*!]*\w[\S]*)", re.UNICODE | re.MULTILINE)
+PUBLIC_PRIVATE_SUFFIX_SEPARATOR = "// ===BEGIN PRIVATE DOMAINS==="
+
+# Number of urls whose results are memoised
+EXTRACT_CACHE_SIZE = 2 ** 16
+
+WILDCARD = "*"
+EXCEPTION = "!"
+
+
+class ExtractResult(collections.namedtuple("ExtractResult", "subdomain domain suffix")):
+    """
+    Same fields as the ExtractResult of tldextract.
+    """
+    __slots__ = ()
+
+    @property
+    def registered_domain(self):
+        if self.domain and self.suffix:
+            return self.domain + "." + self.suffix
+        return ""
+
+
+class _TrieNode:
+    __slots__ = ["children", "is_suffix", "wildcard", "exceptions"]
+
+    def __init__(self):
+        # label -> _TrieNode of the suffix with one more label on the left
+        self.children = {}
+        # whether the labels up to this node are a rule of the list
+        self.is_suffix = False
+        # whether any label on the left of this node is a suffix (a "*." rule)
+        self.wildcard = False
+        # labels on the left of this node that are not a suffix despite the wildcard ("!" rules)
+        self.exceptions = set()
+
+
+class PublicSuffixTrie:
+    """
+    Public suffix rules indexed by their labels from right to left, e.g., "co.uk" is stored under "uk" -> "co".
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: an iterable of rules in the format of the public suffix list, e.g., "com", "*.ck", "!www.ck"
+        """
+        self.root = _TrieNode()
+        self.rule_count = 0
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        is_exception = rule.startswith(EXCEPTION)
+        labels = rule.lstrip(EXCEPTION).split(".")
+        last_label = None
+        if is_exception or labels[0] == WILDCARD:
+            last_label = labels.pop(0)
+        node = self.root
+        for label in reversed(labels):
+            node = node.children.setdefault(label, _TrieNode())
+        if is_exception:
+            node.exceptions.add(last_label)
+        elif last_label == WILDCARD:
+            node.wildcard = True
+        else:
+            node.is_suffix = True
+        self.rule_count += 1
+
+    def suffix_index(self, labels):
+        """
+        :param labels: the lowercase labels of a hostname, from left to right
+        :return: the index of the first label of the longest matching public suffix, or len(labels) if none matches
+        """
+        length = len(labels)
+        index = length
+        node = self.root
+        # The longest match wins, so keep going left while the trie has rules for the labels seen so far
+        for i in range(length - 1, -1, -1):
+            label = labels[i]
+            child = node.children.get(label)
+            if label in node.exceptions:
+                index = i + 1
+            elif (child is not None and child.is_suffix) or node.wildcard:
+                index = i
+            if child is None:
+                break
+            node = child
+        return index
+
+
+def read_snapshot(include_private_domains=False):
+    """
+    :return: the rules of the public suffix list snapshot bundled with tldextract
+    """
+    text = pkgutil.get_data(SNAPSHOT_PACKAGE, SNAPSHOT_RESOURCE).decode("utf-8")
+    public_text, _, private_text = text.partition(PUBLIC_PRIVATE_SUFFIX_SEPARATOR)
+    rules = [m.group("suffix") for m in PUBLIC_SUFFIX_RE.finditer(public_text)]
+    if include_private_domains:
+        rules += [m.group("suffix") for m in PUBLIC_SUFFIX_RE.finditer(private_text)]
+    return rules
+
+
+_trie = None
+
+
+def get_trie():
+    """
+    :return: the trie of the bundled snapshot, loaded on first use
+    """
+    global _trie
+    if _trie is None:
+        _trie = PublicSuffixTrie(read_snapshot())
+    return _trie
+
+
+def _decode_punycode(label):
+    lowered = label.lower()
+    if lowered.startswith("xn--"):
+        try:
+            return idna.decode(label.encode("ascii")).lower()
+        except (UnicodeError, IndexError):
+            pass
+    return lowered
+
+
+@lru_cache(maxsize=EXTRACT_CACHE_SIZE)
+def extract(url):
+    """
+    Splits the hostname of a url (or a hostname) into its subdomain, domain, and public suffix.
+    :param url: a url or a hostname, e.g., "https://forums.bbc.co.uk/path" or "forums.bbc.co.uk"
+    :return: an ExtractResult, e.g., ExtractResult(subdomain="forums", domain="bbc", suffix="co.uk")
+    """
+    netloc = SCHEME_RE.sub("", url) \
+        .partition("/")[0] \
+        .partition("?")[0] \
+        .partition("#")[0] \
+        .split("@")[-1] \
+        .partition(":")[0] \
+        .strip() \
+        .rstrip(".")
+    labels = netloc.split(".")
+    suffix_index = get_trie().suffix_index([_decode_punycode(label) for label in labels])
+
+    suffix = ".".join(labels[suffix_index:])
+    if not suffix and netloc and looks_like_ip(netloc):
+        return ExtractResult("", netloc, "")
+
+    subdomain = ".".join(labels[:suffix_index - 1]) if suffix_index else ""
+    domain = labels[suffix_index - 1] if suffix_index else ""
+    return ExtractResult(subdomain, domain, suffix)
+
+
+def get_registered_domain(url):
+    """
+    :return: the registered domain of a url or hostname, e.g., "bbc.co.uk", or "" if it has none
+    """
+    return extract(url).registered_domain
+
+
+def get_second_level_domain(hostname):
+    """
+    :return: the domain and public suffix of a hostname joined by a dot, as in the second_level_domain column, e.g.,
+             "bbc.co.uk", "192.168.0.1." for an IP address, or "." for an empty hostname
+    """
+    result = extract(hostname)
+    return result.domain + "." + result.suffix
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Prints the subdomain, domain, and public suffix of urls or hostnames, "
+                                             "using the bundled public suffix list snapshot.")
+    ap.add_argument("urls", nargs="+", help="urls or hostnames")
+    args = ap.parse_args()
+
+    for url in args.urls:
+        print(url + " " + " ".join(extract(url)))
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+import os
+import json
+import hashlib
+
+
+class StageManifest(object):
+    """
+    Records, for the pipeline stages that write into one directory, the content hashes of the inputs each stage
+    was run with and the outputs it produced. A stage only has to run again if one of its inputs or parameters
+    changed, or if one of its outputs is gone.
+    """
+
+    MANIFEST_FILE_NAME = ".stage_manifest.json"
+    HASH_BLOCK_SIZE = 1 << 20
+
+    KEY_FILES = "files"
+    KEY_STAGES = "stages"
+    KEY_INPUTS = "inputs"
+    KEY_OUTPUTS = "outputs"
+    KEY_PARAMS = "params"
+
+
+    def __init__(self, directory):
+        """
+        :param directory: the directory that holds the manifest file, usually the one the stages write to
+        """
+        self.path = os.path.join(directory, StageManifest.MANIFEST_FILE_NAME)
+        self.files = {}
+        self.stages = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as mf:
+                    manifest = json.load(mf)
+                self.files = manifest.get(StageManifest.KEY_FILES, {})
+                self.stages = manifest.get(StageManifest.KEY_STAGES, {})
+            except ValueError:
+                print("WARNING: ignoring unreadable stage manifest " + self.path)
+
+
+    def file_digest(self, path):
+        """
+        Returns the SHA-256 digest of a file. Digests are remembered together with the size and modification
+        time of the file, so unchanged files are only hashed once.
+        :param path: path of the file
+        :return: the hex digest, or None if the file does not exist
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        cached = self.files.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(StageManifest.HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+
+    def _input_digests(self, inputs):
+        return {os.path.abspath(path): self.file_digest(path) for path in inputs}
+
+
+    def is_fresh(self, stage, inputs, outputs, params=None):
+        """
+        Checks whether a stage can be skipped.
+        :param stage: unique name of the stage within this manifest
+        :param inputs: list of input files of the stage
+        :param outputs: list of output files of the stage
+        :param params: any JSON-serializable parameters that change what the stage produces
+        :return: True if the stage was recorded with the same inputs and parameters, and all its outputs exist
+        """
+        recorded = self.stages.get(stage)
+        if recorded is None:
+            return False
+        if recorded[StageManifest.KEY_PARAMS] != params:
+            return False
+        if sorted(recorded[StageManifest.KEY_OUTPUTS]) != sorted(os.path.abspath(path) for path in outputs):
+            return False
+        if not all(os.path.isfile(path) for path in outputs):
+            return False
+        return recorded[StageManifest.KEY_INPUTS] == self._input_digests(inputs)
+
+
+    def record(self, stage, inputs, outputs, params=None):
+        """
+        Records a successful run of a stage and writes the manifest to disk, so that an interrupted run can be
+        resumed from the last finished stage.
+        :param stage: unique name of the stage within this manifest
+        :param inputs: list of input files of the stage
+        :param outputs: list of output files of the stage
+        :param params: any JSON-serializable parameters that change what the stage produces
+        """
+        self.stages[stage] = {
+            StageManifest.KEY_INPUTS: self._input_digests(inputs),
+            StageManifest.KEY_OUTPUTS: [os.path.abspath(path) for path in outputs],
+            StageManifest.KEY_PARAMS: params,
+        }
+        self.save()
+
+
+    def invalidate(self, stage):
+        """
+        Forgets about a stage, e.g., before running it again, so that a crash while it runs leaves no stale record.
+        """
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+
+    def save(self):
+        # Write to a temporary file first so that a crash never leaves a truncated manifest behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as mf:
+            json.dump({StageManifest.KEY_FILES: self.files, StageManifest.KEY_STAGES: self.stages}, mf,
+                      sort_keys=True, indent=4)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Checks pcapng_reader against the values that tshark gives for a small PCAPNG trace built here, i.e., the fields that
+the tshark path of extract_from_tshark reads: frame.number, frame.time_epoch, frame.comment, ip.dst, tcp.dstport,
+tcp.stream, and the server name of the ClientHellos.
+
+Run with: python3 -m unittest discover tests (from network_traffic/post-processing)
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_keys
+import packet_store
+import pcapng_reader
+from extract_from_tshark import Extractor
+
+CLIENT_IP = json_keys.ANTMONITOR_SRC_IP
+SERVER_IP = "93.184.216.34"
+CLIENT_IP6 = "fd00::2"
+SERVER_IP6 = "2606:2800:220:1:248:1893:25c8:1946"
+
+COMMENT = json.dumps({json_keys.package_name: "com.example.app", json_keys.version: "1.2.3"})
+
+# Timestamps of the frames, in microseconds since the epoch
+BASE_TS = 1620000000 * 10 ** 6
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def _option(code, value):
+    return struct.pack("<HH", code, len(value)) + value + b"\0" * (-len(value) % 4)
+
+
+def section_header():
+    return _block(pcapng_reader.BLOCK_SECTION_HEADER,
+                  struct.pack("<IHHq", pcapng_reader.BYTE_ORDER_MAGIC, 1, 0, -1))
+
+
+def interface_description(link_type, options=b""):
+    if options:
+        options += _option(pcapng_reader.OPT_ENDOFOPT, b"")
+    return _block(pcapng_reader.BLOCK_INTERFACE_DESCRIPTION, struct.pack("<HHI", link_type, 0, 0) + options)
+
+
+def enhanced_packet(data, ticks, interface_id=0, comment=None):
+    body = struct.pack("<IIIII", interface_id, ticks >> 32, ticks & 0xFFFFFFFF, len(data), len(data))
+    body += data + b"\0" * (-len(data) % 4)
+    if comment is not None:
+        body += _option(pcapng_reader.OPT_COMMENT, comment.encode("utf-8")) + _option(pcapng_reader.OPT_ENDOFOPT, b"")
+    return _block(pcapng_reader.BLOCK_ENHANCED_PACKET, body)
+
+
+def tcp_header(src_port, dst_port, seq, flags):
+    return struct.pack("!HHIIBBHHH", src_port, dst_port, seq, 0, 5 << 4, flags, 65535, 0, 0)
+
+
+def ipv4_tcp(src_ip, dst_ip, src_port, dst_port, seq, flags, payload=b""):
+    segment = tcp_header(src_port, dst_port, seq, flags) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(segment), 0, 0, 64, pcapng_reader.IP_PROTO_TCP, 0,
+                     socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    ethernet = b"\x02" * 6 + b"\x04" * 6 + struct.pack("!H", pcapng_reader.ETHERTYPE_IPV4)
+    return ethernet + ip + segment
+
+
+def ipv6_tcp(src_ip, dst_ip, src_port, dst_port, seq, flags, payload=b""):
+    segment = tcp_header(src_port, dst_port, seq, flags) + payload
+    ip = struct.pack("!IHBB16s16s", 6 << 28, len(segment), pcapng_reader.IP_PROTO_TCP, 64,
+                     socket.inet_pton(socket.AF_INET6, src_ip), socket.inet_pton(socket.AF_INET6, dst_ip))
+    ethernet = b"\x02" * 6 + b"\x04" * 6 + struct.pack("!H", pcapng_reader.ETHERTYPE_IPV6)
+    return ethernet + ip + segment
+
+
+def ipv4_udp(src_ip, dst_ip):
+    udp = struct.pack("!HHHH", 5353, 53, 8, 0)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28, 0, 0, 64, 17, 0, socket.inet_aton(src_ip),
+                     socket.inet_aton(dst_ip))
+    return b"\x02" * 6 + b"\x04" * 6 + struct.pack("!H", pcapng_reader.ETHERTYPE_IPV4) + ip + udp
+
+
+def client_hello(server_name=None):
+    """
+    :return: a TLS record with a ClientHello, with a server name extension after another extension if server_name is
+             given
+    """
+    extensions = struct.pack("!HHH", 0x000B, 2, 0x0100)
+    if server_name is not None:
+        name = server_name.encode("ascii")
+        server_name_list = struct.pack("!BH", pcapng_reader.TLS_SERVER_NAME_HOST_NAME, len(name)) + name
+        extensions += struct.pack("!HHH", pcapng_reader.TLS_EXTENSION_SERVER_NAME, len(server_name_list) + 2,
+                                  len(server_name_list)) + server_name_list
+    hello = b"\x03\x03" + b"\x11" * 32 + b"\x00" + struct.pack("!H", 2) + b"\x13\x01" + b"\x01\x00" + \
+        struct.pack("!H", len(extensions)) + extensions
+    handshake = struct.pack("!B", pcapng_reader.TLS_HANDSHAKE_CLIENT_HELLO) + struct.pack("!I", len(hello))[1:] + hello
+    return struct.pack("!BHH", pcapng_reader.TLS_CONTENT_HANDSHAKE, 0x0301, len(handshake)) + handshake
+
+
+SYN = pcapng_reader.TCP_SYN
+SYN_ACK = pcapng_reader.TCP_SYN | pcapng_reader.TCP_ACK
+PSH_ACK = 0x08 | pcapng_reader.TCP_ACK
+
+SPLIT_HELLO = client_hello("split.example.com")
+
+
+def build_trace():
+    """
+    :return: the bytes of a PCAPNG trace with the frames described below
+    """
+    blocks = [section_header(), interface_description(pcapng_reader.LINKTYPE_ETHERNET),
+              # Nanosecond timestamps, 10 seconds later
+              interface_description(pcapng_reader.LINKTYPE_ETHERNET,
+                                    _option(pcapng_reader.OPT_IF_TSRESOL, b"\x09") +
+                                    _option(pcapng_reader.OPT_IF_TSOFFSET, struct.pack("<q", 10)))]
+    frames = [
+        # 1-3: handshake and ClientHello of stream 0
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 1000, SYN), None),
+        (ipv4_tcp(SERVER_IP, CLIENT_IP, 443, 40000, 5000, SYN_ACK), None),
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 1001, PSH_ACK, client_hello("www.example.com")), COMMENT),
+        # 4: not TCP, still counted as a frame
+        (ipv4_udp(CLIENT_IP, "8.8.8.8"), None),
+        # 5: ClientHello over IPv6, stream 1
+        (ipv6_tcp(CLIENT_IP6, SERVER_IP6, 40001, 443, 7000, PSH_ACK, client_hello("v6.example.org")), COMMENT),
+        # 6: ClientHello without a server name, stream 2
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40002, 8443, 9000, PSH_ACK, client_hello()), COMMENT),
+        # 7: retransmitted SYN of stream 0, same sequence number
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 1000, SYN), None),
+        # 8: SYN that reuses the ports of stream 0 with another sequence number, stream 3
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 20000, SYN), None),
+        # 9-10: ClientHello of stream 3 split over two segments
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 20001, PSH_ACK, SPLIT_HELLO[:30]), COMMENT),
+        (ipv4_tcp(CLIENT_IP, SERVER_IP, 40000, 443, 20031, PSH_ACK, SPLIT_HELLO[30:]), COMMENT),
+    ]
+    for i, (data, comment) in enumerate(frames):
+        blocks.append(enhanced_packet(data, BASE_TS + (i + 1) * 54, comment=comment))
+    # 11: ClientHello on the nanosecond interface, stream 4
+    blocks.append(enhanced_packet(ipv4_tcp(CLIENT_IP, SERVER_IP, 40003, 443, 1, PSH_ACK, client_hello("ns.example.com")),
+                                  1620000000 * 10 ** 9 + 123456789, interface_id=1, comment=COMMENT))
+    return b"".join(blocks)
+
+
+# What tshark gives for the ClientHellos with a server name of the trace:
+# (frame.number, frame.time_epoch, ip.src, ip.dst, tcp.srcport, tcp.dstport, tcp.stream, server name)
+EXPECTED_CLIENT_HELLOS = [
+    (3, "1620000000.000162000", CLIENT_IP, SERVER_IP, 40000, 443, 0, "www.example.com"),
+    (5, "1620000000.000270000", CLIENT_IP6, SERVER_IP6, 40001, 443, 1, "v6.example.org"),
+    (10, "1620000000.000540000", CLIENT_IP, SERVER_IP, 40000, 443, 3, "split.example.com"),
+    (11, "1620000010.123456789", CLIENT_IP, SERVER_IP, 40003, 443, 4, "ns.example.com"),
+]
+
+
+class PcapngReaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.pcap_file = tempfile.mkstemp(suffix=".pcapng")
+        with os.fdopen(fd, "wb") as f:
+            f.write(build_trace())
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.pcap_file)
+
+    def test_frames(self):
+        packets = list(pcapng_reader.iter_packets(self.pcap_file))
+        self.assertEqual([packet.frame_number for packet in packets], list(range(1, 12)))
+        self.assertEqual(packets[0].comment, None)
+        self.assertEqual(packets[2].comment, COMMENT)
+
+    def test_format_ts(self):
+        microseconds = pcapng_reader.Interface(pcapng_reader.LINKTYPE_ETHERNET, 10 ** 6, 0)
+        self.assertEqual(pcapng_reader.format_ts(1620000000 * 10 ** 6 + 54, microseconds), "1620000000.000054000")
+        self.assertEqual(pcapng_reader.format_ts(0, microseconds), "0.000000000")
+        nanoseconds = pcapng_reader.Interface(pcapng_reader.LINKTYPE_ETHERNET, 10 ** 9, 10)
+        self.assertEqual(pcapng_reader.format_ts(1620000000 * 10 ** 9 + 5, nanoseconds), "1620000010.000000005")
+        # Power of 2 resolution
+        binary = pcapng_reader.Interface(pcapng_reader.LINKTYPE_ETHERNET, 2 ** 10, 0)
+        self.assertEqual(pcapng_reader.format_ts(3 * 2 ** 10 + 512, binary), "3.500000000")
+
+    def test_tcp_stream_tracker(self):
+        tracker = pcapng_reader.TcpStreamTracker()
+        client, server = (CLIENT_IP, 40000), (SERVER_IP, 443)
+        self.assertEqual(tracker.get_connection(client, server, 1000, SYN).tcp_stream, 0)
+        self.assertEqual(tracker.get_connection(server, client, 5000, SYN_ACK).tcp_stream, 0)
+        self.assertEqual(tracker.get_connection(client, server, 1001, PSH_ACK).tcp_stream, 0)
+        self.assertEqual(tracker.get_connection((CLIENT_IP, 40001), server, 1, SYN).tcp_stream, 1)
+        # Retransmitted SYN
+        self.assertEqual(tracker.get_connection(client, server, 1000, SYN).tcp_stream, 0)
+        # Port reuse
+        self.assertEqual(tracker.get_connection(client, server, 20000, SYN).tcp_stream, 2)
+        self.assertEqual(tracker.get_connection(server, client, 30000, SYN_ACK).tcp_stream, 2)
+
+    def test_get_server_name(self):
+        self.assertEqual(pcapng_reader.get_server_name(client_hello("www.example.com")), "www.example.com")
+        self.assertIsNone(pcapng_reader.get_server_name(client_hello()))
+        self.assertIsNone(pcapng_reader.get_server_name(client_hello("www.example.com")[:-4]))
+
+    def test_client_hellos(self):
+        client_hellos = list(pcapng_reader.iter_client_hellos(self.pcap_file))
+        self.assertEqual([(c.frame_number, c.ts, c.src_ip, c.dst_ip, c.src_port, c.dst_port, c.tcp_stream,
+                           c.server_name) for c in client_hellos], EXPECTED_CLIENT_HELLOS)
+        self.assertTrue(all(c.comment == COMMENT for c in client_hellos))
+
+    def test_native_tls_packets(self):
+        # The NoMoAds packets that the tshark path gives for the TLS packets of the trace; IPv6 packets are not sent
+        # by AntMonitor and are left out
+        expected = []
+        for frame_number, ts, src_ip, dst_ip, _, dst_port, tcp_stream, server_name in EXPECTED_CLIENT_HELLOS:
+            if src_ip != CLIENT_IP:
+                continue
+            expected.append((packet_store.get_packet_id(frame_number, False), {
+                json_keys.host: server_name,
+                json_keys.protocol: json_keys.ssl,
+                json_keys.src_ip: src_ip,
+                json_keys.dst_ip: dst_ip,
+                json_keys.dst_port: dst_port,
+                json_keys.tcpstream: tcp_stream,
+                json_keys.package_name: "com.example.app",
+                json_keys.version: "1.2.3",
+                json_keys.ts: ts,
+            }))
+        packets = list(Extractor().extract_native_tls_packets(self.pcap_file, set()))
+        self.assertEqual(packets, expected)
+
+        # The TLS packets of decrypted connections are skipped
+        packets = list(Extractor().extract_native_tls_packets(self.pcap_file, {(40000, SERVER_IP)}))
+        self.assertEqual([key for key, _ in packets], [packet_store.get_packet_id(11, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
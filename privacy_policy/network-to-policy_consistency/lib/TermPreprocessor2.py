@@ -3,11 +3,17 @@
 
 import os
 import re
+import sys
 
 from lxml import etree
-import tldextract
 import yaml
 
+# public_suffix is shared with the network traffic post-processing. The directory is appended so that it does not
+# shadow any module of this directory (e.g., post-processing has its own utils package).
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'network_traffic',
+                             'post-processing'))
+import public_suffix
+
 
 def loadAnnotations(filename='synonyms.xml'):
     def getTerm(node):
@@ -209,7 +215,7 @@ def isFirstParty(package_name, dest_domain, privacy_policy, developer_name):
     package_name_tokens = package_name.split(".")
     package_name_tokens = [x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2]
 
-    dest_domain_parsed = tldextract.extract(dest_domain)
+    dest_domain_parsed = public_suffix.extract(dest_domain)
 
     # extract the eSLD for comparison
     # if it's hosted on a cloud service, take the subdomain instead
@@ -220,7 +226,7 @@ def isFirstParty(package_name, dest_domain, privacy_policy, developer_name):
 
     # check privacy policy url first
     if privacy_policy and privacy_policy != "N/A":
-        policy_domain_parsed = tldextract.extract(privacy_policy)
+        policy_domain_parsed = public_suffix.extract(privacy_policy)
         if policy_domain_parsed.registered_domain == domain_cmp:
             return True
 